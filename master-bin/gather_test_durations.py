@@ -0,0 +1,141 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2026 piuparts developers
+#
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import time
+import logging
+import argparse
+import fcntl
+
+import piupartslib.conf
+import piupartslib.durations
+from piupartslib.dwke import get_file_dict, LOG_EXT
+
+
+CONFIG_FILE = "/etc/piuparts/piuparts.conf"
+LOG_DIRS = ('pass', 'bugged', 'affected', 'fail', 'untestable')
+DURATIONS_FILE = "durations.json"
+
+
+class Durations_Config(piupartslib.conf.Config):
+
+    """Configuration parameters for the test duration statistics"""
+
+    def __init__(self, section="global", defaults_section=None):
+        self.section = section
+        piupartslib.conf.Config.__init__(self, section,
+                                         {
+                                         "sections": "report",
+                                         "master-directory": ".",
+                                         },
+                                         defaults_section=defaults_section)
+
+
+def setup_logging(log_level):
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    handler = logging.StreamHandler(sys.stdout)
+    logger.addHandler(handler)
+
+
+def process_section(section, config, max_age, slowest):
+    """ Update durations.json for the logs in this section """
+
+    sectiondir = os.path.join(config['master-directory'], section)
+    if not os.path.isdir(sectiondir):
+        return 0
+
+    workdirs = [os.path.join(sectiondir, x) for x in LOG_DIRS]
+    logdict = get_file_dict([x for x in workdirs if os.path.isdir(x)], LOG_EXT)
+
+    filename = os.path.join(sectiondir, DURATIONS_FILE)
+    try:
+        durations = piupartslib.durations.read_durations(filename)
+    except (ValueError, KeyError, piupartslib.durations.DurationsException):
+        logging.info("%s: discarding invalid %s" % (section, filename))
+        durations = piupartslib.durations.new_durations()
+
+    count = piupartslib.durations.update_durations(durations, logdict, max_age)
+    piupartslib.durations.write_durations(durations, filename)
+
+    for line in piupartslib.durations.report(durations, section, slowest):
+        logging.info(line)
+    logging.info("")
+
+    return count
+
+
+def gather_test_durations(sections, config, max_age, slowest):
+
+    total = 0
+    for section in sections:
+        total += process_section(section, config, max_age, slowest)
+
+    current_time = time.strftime("%a %b %2d %H:%M:%S %Z %Y", time.localtime())
+    logging.info("%s - total parsed logfiles: %d" % (current_time, total))
+    logging.info("")
+
+
+if __name__ == '__main__':
+    setup_logging(logging.DEBUG)
+
+    parser = argparse.ArgumentParser(
+        description="Gather test duration statistics",
+                 epilog="""
+This script collects the Start:/End: stamps and the PIUPARTS-TIMING phase
+records of all log files into a durations.json file per section, parsing
+only new or changed logs, and prints percentiles, the slowest packages,
+per phase totals and the trend by month.
+""")
+
+    parser.add_argument('sections', nargs='*', metavar='SECTION',
+                        help="limit processing to the listed SECTION(s)")
+
+    parser.add_argument('--max-age', dest='max_age', type=int, default=365,
+                        metavar='DAYS',
+                        help="forget tests older than DAYS days (default: 365)")
+
+    parser.add_argument('--slowest', dest='slowest', type=int, default=20,
+                        metavar='N',
+                        help="list the N slowest packages (default: 20)")
+
+    args = parser.parse_args()
+
+    conf = Durations_Config()
+    conf.read(CONFIG_FILE)
+
+    with open(os.path.join(conf['master-directory'], "durations.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            if sys.stdout.isatty():
+                sys.exit("another gather_test_durations process is already running")
+            else:
+                sys.exit(0)
+
+        sections = args.sections
+        if not sections:
+            sections = conf['sections'].split()
+
+        gather_test_durations(sections, conf, args.max_age, args.slowest)
+
+# vi:set et ts=4 sw=4 :
@@ -30,8 +30,11 @@ import os
 import fcntl
 import time
 import random
+import re
+import base64
 
 import piupartslib.conf
+import piupartslib.durations
 import piupartslib.packagesdb
 from piupartslib.packagesdb import LogfileExists
 from piupartslib.conf import MissingSection
@@ -79,6 +82,10 @@ class Config(piupartslib.conf.Config):
                                          "arch": None,
                                          "upgrade-test-distros": None,
                                          "depends-sections": None,
+                                         "expensive-test-duration": 1800,
+                                         "test-timeout-factor": None,
+                                         "test-timeout-min": 600,
+                                         "test-timeout-max": 5400,
                                          },
                                          defaults_section=defaults_section)
 
@@ -127,6 +134,13 @@ class Protocol:
             lines.append(line[1:])
         return "".join(lines)
 
+    def _write_long_part(self, text):
+        logging.debug("<< (%d lines)" % len(text.splitlines()))
+        for line in text.splitlines():
+            self._output.write(" " + line + "\n")
+        self._output.write(".\n")
+        self._output.flush()
+
 
 class Master(Protocol):
 
@@ -142,6 +156,9 @@ class Master(Protocol):
             "pass": self._pass,
             "fail": self._fail,
             "untestable": self._untestable,
+            "refchroot-get": self._refchroot_get,
+            "refchroot-put": self._refchroot_put,
+            "refchroot-drop": self._refchroot_drop,
 
             # debug commands, unstable and undocumented interface
             "_state": self._state,
@@ -166,12 +183,17 @@ class Master(Protocol):
         self._idle_stamp = os.path.join(section, "idle.stamp")
         self._package_databases = None
         self._binary_db = None
+        self._max_expected_duration = None
 
         config = Config(section=section, defaults_section="global")
         try:
             config.read(CONFIG_FILE)
         except MissingSection:
             return False
+        self._expensive_test_duration = int(config["expensive-test-duration"])
+        self._test_timeout_factor = float(config["test-timeout-factor"] or 0)
+        self._test_timeout_min = int(config["test-timeout-min"])
+        self._test_timeout_max = int(config["test-timeout-max"])
 
         if not os.path.exists(section):
             os.makedirs(section)
@@ -322,15 +344,30 @@ class Master(Protocol):
     def _reserve(self, command, args):
         self._check_args(0, command, args)
         self._init_db()
-        package = self._binary_db.reserve_package()
+        package = self._binary_db.reserve_package(self._max_expected_duration)
         if package is None:
-            self._set_idle()
+            if self._max_expected_duration is None:
+                self._set_idle()
             self._short_response("error")
         else:
             self._clear_idle()
+            expected = self._binary_db.get_expected_duration(package.name()) or 0
+            if self._expensive_test_duration and expected >= self._expensive_test_duration:
+                # hand out at most one expensive package per connection
+                # to spread them across the slaves
+                self._max_expected_duration = self._expensive_test_duration
+            timeout = None
+            if self._test_timeout_factor:
+                timeout = piupartslib.durations.get_adaptive_timeout(
+                    self._binary_db.get_package_durations(package.name()),
+                    self._test_timeout_factor,
+                    self._test_timeout_min,
+                    self._test_timeout_max)
             self._short_response("ok",
                                  package.name(),
-                                 package.test_versions())
+                                 package.test_versions(),
+                                 "%d" % expected,
+                                 "%d" % (timeout or 0))
 
     def _unreserve(self, command, args):
         self._check_args(2, command, args)
@@ -367,6 +404,64 @@ class Master(Protocol):
                          % ("untestable", args[0], args[1]))
         self._short_response("ok")
 
+    def _refchroot_path(self, key=None):
+        path = os.path.join(self._section, "refchroot")
+        if key is not None:
+            path = os.path.join(path, key + ".dat")
+        return path
+
+    def _check_refchroot_key(self, command, key):
+        # the history of 'apt-cache dumpavail | md5sum' of all distros
+        if not re.match(r"^[0-9a-f]{32}(,[0-9a-f]{32})*$", key):
+            raise CommandSyntaxError("Invalid reference chroot key: %s %s" %
+                                     (command, key))
+
+    def _refchroot_get(self, command, args):
+        self._check_args(0, command, args)
+        keys = []
+        if os.path.isdir(self._refchroot_path()):
+            keys = [x[:-len(".dat")] for x in os.listdir(self._refchroot_path())
+                    if x.endswith(".dat")]
+        if not keys:
+            self._short_response("error")
+            return
+        key = max(keys, key=lambda k: os.path.getmtime(self._refchroot_path(k)))
+        with open(self._refchroot_path(key), "rb") as f:
+            data = f.read()
+        self._short_response("ok", key)
+        self._write_long_part(base64.encodebytes(data).decode("ascii"))
+
+    def _refchroot_put(self, command, args):
+        self._check_args(1, command, args)
+        key = args[0]
+        self._check_refchroot_key(command, key)
+        try:
+            data = base64.b64decode(self._read_long_part())
+        except ValueError:
+            self._short_response("error")
+            return
+        if not os.path.exists(self._refchroot_path()):
+            os.makedirs(self._refchroot_path())
+        tmpfile = self._refchroot_path(key) + ".new"
+        with open(tmpfile, "wb") as f:
+            f.write(data)
+        os.rename(tmpfile, self._refchroot_path(key))
+        # older histories are superseded by the new upload
+        for basename in os.listdir(self._refchroot_path()):
+            if basename.endswith(".dat") and basename != key + ".dat":
+                os.unlink(os.path.join(self._refchroot_path(), basename))
+        logging.info("Stored reference chroot meta data for %s" % key)
+        self._short_response("ok")
+
+    def _refchroot_drop(self, command, args):
+        self._check_args(1, command, args)
+        key = args[0]
+        self._check_refchroot_key(command, key)
+        if os.path.exists(self._refchroot_path(key)):
+            os.unlink(self._refchroot_path(key))
+            logging.info("Dropped reference chroot meta data for %s" % key)
+        self._short_response("ok")
+
     # debug command
     def _state(self, command, args):
         self._check_args(1, command, args)
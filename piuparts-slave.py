@@ -24,10 +24,12 @@ Lars Wirzenius <liw@iki.fi>
 """
 from __future__ import print_function
 
+import base64
 import fcntl
 import logging
 import os
 import random
+import re
 import shlex
 import stat
 import subprocess
@@ -99,6 +101,7 @@ class Config(piupartslib.conf.Config):
                                          "chroot-meta-auto": None,
                                          "chroot-meta-directory": None,
                                          "max-reserved": 1,
+                                         "max-reserved-duration": None,
                                          "debug": "no",
                                          "keep-sources-list": "no",
                                          "arch": None,
@@ -193,6 +196,20 @@ class Slave:
         logging.debug("<< " + str(line.rstrip()))
         return line
 
+    def _read_long_part(self):
+        lines = []
+        while True:
+            line = self._from_master.readline()
+            if not line:
+                raise MasterCommunicationFailed()
+            if line == ".\n":
+                break
+            if line[0] != " ":
+                raise MasterIsCrazy()
+            lines.append(line[1:])
+        logging.debug("<< (%d lines)" % len(lines))
+        return "".join(lines)
+
     def _writeline(self, *words):
         line = " ".join(words)
         logging.debug(">> " + line)
@@ -312,8 +329,10 @@ class Slave:
         line = self._readline()
         words = line.split()
         if words and words[0] == "ok":
-            logging.info("Reserved for us: %s %s" % (words[1], words[2]))
-            self.remember_reservation(words[1], words[2])
+            expected = int(words[3]) if len(words) > 3 else 0
+            timeout = int(words[4]) if len(words) > 4 else 0
+            logging.info("Reserved for us: %s %s (expected runtime: %ds)" % (words[1], words[2], expected))
+            self.remember_reservation(words[1], words[2], expected, timeout)
             return True
         elif words and words[0] == "error":
             logging.info("Master didn't reserve anything (more) for us")
@@ -331,11 +350,67 @@ class Slave:
         if line != "ok\n":
             raise MasterNotOK()
 
+    def get_refchroot_metadata(self, filename):
+        self._writeline("refchroot-get")
+        line = self._readline()
+        words = line.split()
+        if words and words[0] == "ok" and len(words) == 2:
+            try:
+                data = base64.b64decode(self._read_long_part())
+            except ValueError:
+                raise MasterIsCrazy()
+            with open(filename + ".new", "wb") as f:
+                f.write(data)
+            os.rename(filename + ".new", filename)
+            logging.info("Fetched reference chroot meta data for %s" % words[1])
+            return words[1]
+        elif line == "error\n":
+            return None
+        else:
+            raise MasterIsCrazy()
+
+    def put_refchroot_metadata(self, key, filename):
+        logging.info("Sending reference chroot meta data for %s" % key)
+        self._writeline("refchroot-put", key)
+        with open(filename, "rb") as f:
+            data = base64.encodebytes(f.read()).decode("ascii")
+        for line in data.splitlines():
+            self._to_master.write(" " + line + "\n")
+        self._writeline(".")
+        line = self._readline()
+        if line != "ok\n":
+            raise MasterNotOK()
+
+    def drop_refchroot_metadata(self, key):
+        logging.info("Dropping reference chroot meta data for %s" % key)
+        self._writeline("refchroot-drop", key)
+        line = self._readline()
+        if line != "ok\n":
+            raise MasterNotOK()
+
     def _reserved_filename(self, name, version):
         return os.path.join("reserved", "%s_%s.log" % (name, version))
 
-    def remember_reservation(self, name, version):
-        create_file(self._reserved_filename(name, version), "")
+    def remember_reservation(self, name, version, expected=0, timeout=0):
+        create_file(self._reserved_filename(name, version), "%d %d\n" % (expected, timeout))
+
+    def _get_reservation_info(self, name, version):
+        # (expected runtime, test timeout) as sent by the master, 0 if unknown
+        try:
+            expected, timeout = read_file(self._reserved_filename(name, version)).split()
+            return int(expected), int(timeout)
+        except (IOError, ValueError):
+            return 0, 0
+
+    def get_expected_duration(self, name, version):
+        return self._get_reservation_info(name, version)[0]
+
+    def get_test_timeout(self, name, version):
+        return self._get_reservation_info(name, version)[1]
+
+    def get_reserved_duration(self):
+        return sum([self.get_expected_duration(name, version)
+                    for name, version in self.get_reserved()])
 
     def get_reserved(self):
         vlist = []
@@ -477,12 +552,42 @@ class Section:
             if os.path.exists(refchroot_metadata):
                 try:
                     age = time.time() - os.path.getmtime(refchroot_metadata)
-                    if age > 6 * 3600:
+                    if age > 6 * 3600 and not os.path.exists(refchroot_metadata + ".upload"):
                         os.unlink(refchroot_metadata)
                         logging.info("Deleting old %s" % refchroot_metadata)
                 except OSError:
                     pass
 
+    def _forget_refchroot_metadata(self, refchroot_metadata):
+        """Delete outdated reference chroot meta data and remember to drop it from the master, too."""
+        os.unlink(refchroot_metadata)
+        if os.path.exists(refchroot_metadata + ".upload"):
+            os.unlink(refchroot_metadata + ".upload")
+        if os.path.exists(refchroot_metadata + ".key"):
+            os.rename(refchroot_metadata + ".key", refchroot_metadata + ".drop")
+
+    def _sync_refchroot_metadata(self, fetch=False):
+        """Share the reference chroot meta data of distupgrade tests via the master.
+
+        The meta data is keyed by the history of available packages, the
+        key of the local copy is kept in a ".key" file next to it.
+        """
+        refchroot_metadata = self._get_refchroot_metadata()
+        if not refchroot_metadata or len(self._config.get_distros()) <= 1:
+            return
+        if os.path.exists(refchroot_metadata + ".drop"):
+            self._slave.drop_refchroot_metadata(read_file(refchroot_metadata + ".drop"))
+            os.unlink(refchroot_metadata + ".drop")
+        if os.path.exists(refchroot_metadata + ".upload"):
+            if os.path.exists(refchroot_metadata):
+                key = read_file(refchroot_metadata + ".upload")
+                self._slave.put_refchroot_metadata(key, refchroot_metadata)
+            os.unlink(refchroot_metadata + ".upload")
+        if fetch and not os.path.exists(refchroot_metadata):
+            key = self._slave.get_refchroot_metadata(refchroot_metadata)
+            if key is not None:
+                create_file(refchroot_metadata + ".key", key)
+
     def _count_submittable_logs(self):
         files = 0
         subdirs = ["pass", "fail", "untestable"]
@@ -624,8 +729,11 @@ class Section:
                                 self._slave.unreserve(fullname)
                                 os.remove(fullname)
 
+                self._sync_refchroot_metadata(fetch=fetch)
+
                 if fetch:
                     max_reserved = int(self._config["max-reserved"])
+                    max_reserved_duration = int(self._config["max-reserved-duration"] or 0)
                     idle = self._slave.get_idle()
                     if idle > 0:
                         idle = min(idle, int(self._config["idle-sleep"]))
@@ -635,7 +743,10 @@ class Section:
                         else:
                             self._recycle_wait_until = time.time() + idle
                         return 0
-                    while len(self._slave.get_reserved()) < max_reserved and self._slave.reserve():
+                    while len(self._slave.get_reserved()) < max_reserved and \
+                            (not max_reserved_duration or
+                             self._slave.get_reserved_duration() < max_reserved_duration) and \
+                            self._slave.reserve():
                         pass
                     self._slave.get_status(self._config.section)
             except MasterNotOK:
@@ -714,6 +825,12 @@ class Section:
 
         distupgrade = len(self._config.get_distros()) > 1
 
+        timeout = self._slave.get_test_timeout(pname, pvers)
+        if timeout:
+            output.write("Timeout: %d seconds (derived from previous tests)\n" % timeout)
+        else:
+            timeout = MAX_WAIT_TEST_RUN
+
         command = []
         if self._config["setarch"]:
             command.append("setarch")
@@ -731,6 +848,8 @@ class Section:
         if self._config["tmpdir"]:
             command.extend(["--tmpdir", self._config["tmpdir"]])
         command.extend(["--arch", self._config.get_arch()])
+        if timeout < MAX_WAIT_TEST_RUN:
+            command.extend(["--max-command-runtime", "%d" % timeout])
         command.extend(["-b", self._get_tarball()])
         if not distupgrade:
             command.extend(["-d", self._config.get_distro()])
@@ -812,25 +931,30 @@ class Section:
 
         if ret == 0:
             output.write("Executing: %s\n" % command2string(command))
-            ret, f = run_test_with_timeout(command, MAX_WAIT_TEST_RUN)
+            ret, f = run_test_with_timeout(command, timeout)
             if not f or f[-1] != '\n':
                 f += '\n'
             output.write(f.replace('\033', '[ESC]'))
             lastline = f.split('\n')[-2]
             if ret < 0:
-                output.write(" *** Process KILLED - exceed maximum run time ***\n")
+                output.write(" *** Process KILLED - exceed maximum run time (%d s) ***\n" % timeout)
             elif not "piuparts run ends" in lastline:
                 ret += 1024
                 output.write(" *** PIUPARTS OUTPUT INCOMPLETE ***\n")
             elif distupgrade and self._config["chroot-meta-auto"]:
                 try:
                     refchroot_metadata = self._get_refchroot_metadata()
+                    saved = re.search(r"Saved reference chroot state to .* \(available packages history: ([0-9a-f ]+)\)", f)
                     if "History of available packages does not match - reference chroot may be outdated" in f:
-                        os.unlink(refchroot_metadata)
+                        self._forget_refchroot_metadata(refchroot_metadata)
                         logging.info("Deleting outdated %s" % refchroot_metadata)
                     elif "Initial package selections do not match - ignoring loaded reference chroot state" in f:
-                        os.unlink(refchroot_metadata)
+                        self._forget_refchroot_metadata(refchroot_metadata)
                         logging.info("Deleting mismatching %s" % refchroot_metadata)
+                    elif saved and os.path.exists(refchroot_metadata):
+                        key = ",".join(saved.group(1).split())
+                        create_file(refchroot_metadata + ".key", key)
+                        create_file(refchroot_metadata + ".upload", key)
                 except OSError:
                     pass
 
@@ -985,6 +1109,11 @@ def create_file(filename, contents):
         f.write(contents)
 
 
+def read_file(filename):
+    with open(filename, "r") as f:
+        return f.read().strip()
+
+
 def main():
     setup_logging(logging.INFO, None)
     signal(SIGHUP, sighup_handler)
@@ -35,6 +35,12 @@ from __future__ import print_function
 VERSION = "__PIUPARTS_VERSION__"
 
 
+import array
+import fcntl
+import functools
+import glob
+import hashlib
+import io
 import json
 import logging
 import optparse
@@ -45,6 +51,7 @@ import re
 import shlex
 import shutil
 import stat
+import struct
 import subprocess
 import sys
 import tarfile
@@ -52,7 +59,10 @@ import tempfile
 import time
 import traceback
 import uuid
+import zlib
 from collections import namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
 from signal import SIGALRM, SIGKILL, SIGTERM, alarm, signal
 
 import apt_pkg
@@ -67,6 +77,7 @@ import six
 from six.moves import urllib
 
 import piupartslib.conf
+from piupartslib.packagesdb import Package, rfc822_like_header_parse
 
 apt_pkg.init_system()
 
@@ -163,6 +174,8 @@ class Settings:
         self.max_command_runtime = 60 * 60  # 60 minutes (texlive-full and blends metapackages on dist-upgrade)
         self.single_changes_list = False
         self.single_packages = False
+        self.batch = False
+        self.jobs = 1
         self.args_are_package_files = True
         # distro setup
         self.proxy = None
@@ -189,16 +202,25 @@ class Settings:
         self.savetgz = None
         self.lvm_volume = None
         self.lvm_snapshot_size = "1G"
+        self.tmpfs_size = None
+        self.tmpfs_max_installed_size = None
+        self.apt_archive_cache = None
+        self.apt_archive_cache_size = None
+        self.apt_lists_cache = None
+        self.apt_lists_cache_max_age = 60
         self.existing_chroot = None
         self.hard_link = False
         self.schroot = None
         self.end_meta = None
         self.save_end_meta = None
+        self.reference_meta_cache = False
         self.skip_minimize = True
         self.minimize = False
         self.debfoster_options = None
         self.docker_image = None
         self.merged_usr = False
+        self.tree_scan_threads = 0
+        self.chroot_agent = False
         # tests and checks
         self.no_install_purge_test = False
         self.no_upgrade_test = False
@@ -483,6 +505,63 @@ def setup_logging(log_level, log_file_name):
         HANDLERS.append(handler)
 
 
+def set_log_prefix(prefix):
+    """Prefix all log messages, e.g. to tell parallel jobs apart."""
+    for handler in HANDLERS:
+        formatter = TimeOffsetFormatter("%(asctime)s " + prefix + " %(levelname)s: %(message)s")
+        formatter.startup_time = handler.formatter.startup_time
+        handler.setFormatter(formatter)
+
+
+phase_timings = {}
+
+
+class PhaseTimer:
+
+    """Measure how long a phase of the test takes, to be used as a context
+    manager.  Each finished phase is logged as a
+    'PIUPARTS-TIMING phase=NAME seconds=SECONDS' record and added up for
+    log_timing_summary().  Phases may be nested."""
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            # panic() has already written the summary
+            return
+        seconds = time.monotonic() - self.start
+        count, total = phase_timings.get(self.phase, (0, 0.0))
+        phase_timings[self.phase] = (count + 1, total + seconds)
+        logging.info("PIUPARTS-TIMING phase=%s seconds=%.1f" % (self.phase, seconds))
+
+
+def timed(phase):
+    """Decorator running the whole function as a PhaseTimer phase."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with PhaseTimer(phase):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log_timing_summary():
+    """Log a table of the accumulated phase timings."""
+    if not phase_timings:
+        return
+    lines = ["%-24s %5s %9s" % ("phase", "count", "seconds")]
+    for phase, (count, total) in phase_timings.items():
+        lines.append("%-24s %5d %9.1f" % (phase, count, total))
+    logging.info("PIUPARTS-TIMING summary (phases may be nested):\n" + indent_string("\n".join(lines)))
+
+
 def dump(msg):
     logger = logging.getLogger()
     logger.log(DUMP, msg)
@@ -494,13 +573,14 @@ def panic(exit=1):
     for i in reversed(range(counter)):
         if i in on_panic_hooks:
             on_panic_hooks[i]()
+    log_timing_summary()
     logging.error("piuparts run ends.")
     sys.exit(exit)
 
 
 def indent_string(str):
     """Indent all lines in a string with two spaces and return result."""
-    return "\n".join(["  " + line for line in str.split("\n")])
+    return "  " + str.replace("\n", "\n  ")
 
 
 def command2string(command):
@@ -539,6 +619,55 @@ def run(command, ignore_errors=False, timeout=0):
 
     assert isinstance(command, type([]))
     logging.debug("Starting command: %s" % command)
+    devnull = open('/dev/null', 'r')
+    p = subprocess.Popen(command, env=command_environment(), stdin=devnull,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    # Collect the raw output in a list of chunks and decode it once at the
+    # end, appending to a string would copy the whole output for each chunk.
+    chunks = []
+    size = 0
+    message = ""
+    if timeout > 0:
+        signal(SIGALRM, alarm_handler)
+        alarm(timeout)
+    try:
+        fd = p.stdout.fileno()
+        while True:
+            """Read up to 64 KB at a time, as much as is available.
+            Abort after reading max_command_output_size bytes."""
+            chunk = os.read(fd, 1 << 16)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > settings.max_command_output_size:
+                ignore_errors = False
+                alarm(0)
+                kill_subprocess(p, "excessive output")
+                message = "\n\n***** Command was terminated after exceeding output limit (%.2f MB) *****\n" \
+                          % (settings.max_command_output_size / 1024. / 1024.)
+                break
+        p.wait()
+        alarm(0)
+    except Alarm:
+        ignore_errors = False
+        kill_subprocess(p, "excessive runtime")
+        message = "\n\n***** Command was terminated after exceeding runtime limit (%s s) *****\n" % timeout
+    p.stdout.close()
+    devnull.close()
+    output = decode_output(chunks) + message
+
+    return log_command_result(command, p.returncode, output, ignore_errors)
+
+
+def decode_output(chunks):
+    """Decode the raw output chunks of a command like universal_newlines=True would."""
+    output = b"".join(chunks).decode(errors="backslashreplace")
+    return output.replace("\r\n", "\n").replace("\r", "\n")
+
+
+def command_environment():
+    """Return the environment for commands started by piuparts."""
     env = os.environ.copy()
     for var in ["LANG",
             "LANGUAGE",
@@ -558,51 +687,174 @@ def run(command, ignore_errors=False, timeout=0):
         if var in env:
             del env[var]
     env["PIUPARTS_OBJECTS"] = ' '.join(str(vobject) for vobject in settings.testobjects)
-    devnull = open('/dev/null', 'r')
-    p = subprocess.Popen(command, env=env, stdin=devnull,
-                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                         universal_newlines=True, errors="backslashreplace")
-    output = ""
-    excessive_output = False
-    if timeout > 0:
-        signal(SIGALRM, alarm_handler)
-        alarm(timeout)
-    try:
-        while p.poll() is None:
-            """Read 64 KB chunks, but depending on the output buffering behavior
-            of the command we may get less even if more output is coming later.
-            Abort after reading max_command_output_size bytes."""
-            output += p.stdout.read(1 << 16)
-            if (len(output) > settings.max_command_output_size):
-                excessive_output = True
-                ignore_errors = False
-                alarm(0)
-                kill_subprocess(p, "excessive output")
-                output += "\n\n***** Command was terminated after exceeding output limit (%.2f MB) *****\n" \
-                          % (settings.max_command_output_size / 1024. / 1024.)
-                break
-        if not excessive_output:
-            output += p.stdout.read(settings.max_command_output_size)
-        alarm(0)
-    except Alarm:
-        ignore_errors = False
-        kill_subprocess(p, "excessive runtime")
-        output += "\n\n***** Command was terminated after exceeding runtime limit (%s s) *****\n" % timeout
-    devnull.close()
+    return env
+
 
+def log_command_result(command, returncode, output, ignore_errors):
+    """Log the output of a finished command and die if it failed."""
     if output:
         dump("\n" + indent_string(output.rstrip("\n")))
 
-    if p.returncode == 0:
+    if returncode == 0:
         logging.debug("Command ok: %s" % repr(command))
     elif ignore_errors:
         logging.debug("Command failed (status=%d), but ignoring error: %s" %
-                      (p.returncode, repr(command)))
+                      (returncode, repr(command)))
     else:
         logging.error("Command failed (status=%d): %s\n%s" %
-                      (p.returncode, repr(command), indent_string(output)))
+                      (returncode, repr(command), indent_string(output)))
         panic()
-    return p.returncode, output
+    return returncode, output
+
+
+class ChrootAgent:
+
+    """A shell kept running inside the chroot that executes commands sent
+    to it over a pipe, to avoid setting up a new chroot for every command.
+
+    Each command is followed by printing a marker line with its exit status.
+    The PIUPARTS_* variables change during a run, so their current values
+    are exported to the shell with every command.
+    If a command exceeds the output or runtime limits, the whole process
+    group of the agent is killed and a new agent is started on demand."""
+
+    def __init__(self, command):
+        self.command = command
+        self.process = None
+        self.marker = ("PIUPARTS-AGENT-%s" % os.urandom(8).hex()).encode()
+        self.exported = set()
+
+    def start(self):
+        logging.debug("Starting chroot agent: %s" % self.command)
+        env = command_environment()
+        self.exported = set([var for var in env if var.startswith("PIUPARTS_")])
+        try:
+            self.process = subprocess.Popen(self.command, env=env,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, cwd="/",
+                                            start_new_session=True)
+        except OSError as e:
+            logging.debug("Chroot agent is not available: %s" % e)
+            return False
+        status, output = self.communicate("cd / && printf '\\n%s %s\\n' " +
+                                          self.marker.decode() + " 0\n")
+        if status != 0:
+            logging.debug("Chroot agent is not available:\n%s" % indent_string(output))
+            self.stop()
+            return False
+        return True
+
+    def stop(self):
+        if self.process is None:
+            return
+        logging.debug("Stopping chroot agent")
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        try:
+            self.process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.kill("shutdown")
+        self.process.stdout.close()
+        self.process = None
+
+    def kill(self, reason):
+        """Kill the agent together with the command it is running."""
+        logging.error("Terminating command due to %s" % reason)
+        p = self.process
+        try:
+            os.killpg(p.pid, SIGTERM)
+            for i in range(10):
+                time.sleep(0.5)
+                if p.poll() is not None:
+                    break
+            else:
+                logging.error("Killing command due to %s" % reason)
+                os.killpg(p.pid, SIGKILL)
+        except ProcessLookupError:
+            pass
+        p.wait()
+
+    def communicate(self, line, timeout=0):
+        """Send a line of shell code to the agent and read the output up
+        to the marker line. Returns the exit status and the output."""
+        try:
+            self.process.stdin.write(line.encode())
+            self.process.stdin.flush()
+        except OSError:
+            return -1, ""
+        fd = self.process.stdout.fileno()
+        end = re.compile(b"\n" + self.marker + b" (-?[0-9]+)\n$")
+        chunks = []
+        size = 0
+        tail = b""
+        status = None
+        message = ""
+        if timeout > 0:
+            signal(SIGALRM, alarm_handler)
+            alarm(timeout)
+        try:
+            while True:
+                chunk = os.read(fd, 1 << 16)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+                tail = (tail + chunk)[-len(self.marker) - 32:]
+                if end.search(tail):
+                    data = b"".join(chunks)
+                    match = end.search(data, len(data) - len(tail))
+                    status = int(match.group(1))
+                    chunks = [data[:match.start()]]
+                    break
+                if size > settings.max_command_output_size:
+                    alarm(0)
+                    self.kill("excessive output")
+                    message = "\n\n***** Command was terminated after exceeding output limit (%.2f MB) *****\n" \
+                              % (settings.max_command_output_size / 1024. / 1024.)
+                    break
+            alarm(0)
+        except Alarm:
+            self.kill("excessive runtime")
+            message = "\n\n***** Command was terminated after exceeding runtime limit (%s s) *****\n" % timeout
+        output = decode_output(chunks) + message
+        if status is None:
+            # the agent is gone, it will be restarted for the next command
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.kill("lost agent")
+            status = self.process.returncode or -1
+            self.process.stdin.close()
+            self.process.stdout.close()
+            self.process = None
+        return status, output
+
+    def environment_update(self):
+        """Return shell code setting the PIUPARTS_* variables to their
+        current values and unsetting the ones that are gone."""
+        env = command_environment()
+        current = sorted([var for var in env if var.startswith("PIUPARTS_")])
+        stale = sorted(self.exported - set(current))
+        self.exported = set(current)
+        code = "export %s; " % " ".join(["%s=%s" % (var, shlex.quote(env[var])) for var in current])
+        if stale:
+            code = "unset %s; " % " ".join(stale) + code
+        return code
+
+    def run(self, command, logged_command, ignore_errors=False, timeout=0):
+        """Run a command in the agent, like run() would run logged_command."""
+        assert isinstance(command, type([]))
+        if self.process is None and not self.start():
+            return run(logged_command, ignore_errors=ignore_errors, timeout=timeout)
+        logging.debug("Starting command: %s" % logged_command)
+        line = self.environment_update() + "%s </dev/null 2>&1; printf '\\n%%s %%s\\n' %s \"$?\"\n" % \
+               (command2string(command), self.marker.decode())
+        status, output = self.communicate(line, timeout)
+        if status != 0 and self.process is None:
+            ignore_errors = False
+        return log_command_result(logged_command, status, output, ignore_errors)
 
 
 def create_temp_file():
@@ -693,7 +945,7 @@ def split_path(pathname):
     return parts
 
 
-def canonicalize_path(root, pathname, report_links=False):
+def canonicalize_path(root, pathname, report_links=False, cache=None):
     """Canonicalize a path name, simulating chroot at 'root'.
 
     When resolving the symlink, pretend (similar to chroot) that
@@ -705,14 +957,37 @@ def canonicalize_path(root, pathname, report_links=False):
     Returns the final canonical path or a list of (path, target) tuples,
     one for each symlink encountered.
 
+    'cache' may be a dict shared between calls on the same (unmodified)
+    tree below 'root'. It remembers the resolved prefixes of all path
+    names, so paths sharing (parts of) a directory are resolved only once.
+    It is not used if 'report_links' is set.
+
     """
     # print("\nCANONICALIZE %s %s" % (root, pathname))
+    if report_links:
+        cache = None
     links = []
-    seen = []
+    seen = set()
     parts = split_path(pathname)
+    orig = parts[:]
     # print("PARTS ", list(reversed(parts)))
     path = "/"
-    while parts:
+    if cache is not None:
+        for i in range(len(orig)):
+            prefix = os.path.join(*reversed(orig[i:]))
+            if prefix in cache:
+                path = cache[prefix]
+                parts = orig[:i]
+                break
+    # the first 'remaining' parts are still unresolved parts of 'pathname'
+    remaining = len(parts)
+    resolved = False
+    while True:
+        if resolved and len(parts) == remaining:
+            cache[os.path.join(*reversed(orig[remaining:]))] = path
+            resolved = False
+        if not parts:
+            break
         tag = "\n".join(parts + [path])
         # print("TEST '%s' + " % path, list(reversed(parts)))
         if tag in seen or len(seen) > 1024:
@@ -721,7 +996,10 @@ def canonicalize_path(root, pathname, report_links=False):
             path = fullpath
             logging.error("ELOOP: Too many symbolic links in '%s'" % path)
             break
-        seen.append(tag)
+        seen.add(tag)
+        if cache is not None and len(parts) == remaining:
+            remaining -= 1
+            resolved = True
         part = parts.pop()
         # Using normpath() to cleanup '.', '..' and multiple slashes.
         # Removing a suffix 'foo/..' is safe here since it can't change the
@@ -746,12 +1024,12 @@ def canonicalize_path(root, pathname, report_links=False):
     return path
 
 
-def is_broken_symlink(root, dirpath, filename):
+def is_broken_symlink(root, dirpath, filename, cache=None):
     """Is symlink dirpath+filename broken?"""
 
     if dirpath[:len(root)] == root:
         dirpath = dirpath[len(root):]
-    pathname = canonicalize_path(root, os.path.join(dirpath, filename))
+    pathname = canonicalize_path(root, os.path.join(dirpath, filename), cache=cache)
     pathname = os.path.join(root, pathname[1:])
 
     # The symlink chain, if any, has now been resolved. Does the target
@@ -761,6 +1039,204 @@ def is_broken_symlink(root, dirpath, filename):
 
 
 FileInfo = namedtuple('FileInfo', ['st', 'target', 'user', 'group'])
+ChrootScan = namedtuple('ChrootScan', ['tree', 'broken_symlinks', 'path_cache'])
+StatInfo = namedtuple('StatInfo', ['st_mode', 'st_uid', 'st_gid', 'st_size'])
+
+
+class TreeMetaData(Mapping):
+
+    """Filesystem meta data of a directory tree.
+
+    This behaves like a read-only dict[pathname] = FileInfo, but only keeps
+    mode, uid, gid, size and symlink target of each object, stored in
+    arrays indexed by the (interned) path names.  The FileInfo objects are
+    created on access.
+
+    """
+
+    def __init__(self, uidmap=None, gidmap=None):
+        self.uidmap = uidmap or {}
+        self.gidmap = gidmap or {}
+        self.index = {}
+        self.mode = array.array('I')
+        self.uid = array.array('I')
+        self.gid = array.array('I')
+        self.size = array.array('Q')
+        self.targets = {}
+
+    def add(self, name, st_mode, st_uid, st_gid, st_size, target=None):
+        i = len(self.mode)
+        self.index[sys.intern(name)] = i
+        self.mode.append(st_mode)
+        self.uid.append(st_uid)
+        self.gid.append(st_gid)
+        self.size.append(st_size)
+        if target is not None:
+            self.targets[i] = target
+
+    def user(self, uid):
+        if uid in self.uidmap:
+            return self.uidmap[uid]
+        return "#%d" % uid
+
+    def group(self, gid):
+        if gid in self.gidmap:
+            return self.gidmap[gid]
+        return "#%d" % gid
+
+    def __getitem__(self, name):
+        i = self.index[name]
+        uid = self.uid[i]
+        gid = self.gid[i]
+        return FileInfo(StatInfo(self.mode[i], uid, gid, self.size[i]),
+                        self.targets.get(i), self.user(uid), self.group(gid))
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def copy(self):
+        return dict(self.items())
+
+    def symlinks(self):
+        """Return the names of all symlinks in the tree."""
+        names = list(self.index)
+        return [names[i] for i in sorted(self.targets)]
+
+
+def scan_directory(root, dirpath, skip, recursive=True):
+    """Scan 'dirpath' (relative to 'root', with a trailing slash) and,
+    if 'recursive', everything below it, except for the directories in
+    'skip'.
+
+    Return a list of (name, stat, target) tuples and the list of
+    subdirectories that were not scanned.  Like os.walk(), symlinks
+    pointing to directories are not recorded.
+
+    """
+    result = []
+    pending = [dirpath]
+    unscanned = []
+    while pending:
+        dirpath = pending.pop()
+        if dirpath in skip:
+            continue
+        result.append((dirpath, os.lstat(root + dirpath), None))
+        try:
+            entries = list(os.scandir(root + dirpath))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                if not entry.is_symlink():
+                    if recursive:
+                        pending.append(dirpath + entry.name + "/")
+                    else:
+                        unscanned.append(dirpath + entry.name + "/")
+                continue
+            st = entry.stat(follow_symlinks=False)
+            if stat.S_ISLNK(st.st_mode):
+                target = os.readlink(entry.path)
+            else:
+                target = None
+            result.append((dirpath + entry.name, st, target))
+    return result, unscanned
+
+
+def scan_tree_meta_data(root, uidmap=None, gidmap=None, skip=(), threads=0):
+    """Return the filesystem meta data for all objects below 'root' as a
+    TreeMetaData object.  The directories in 'skip' (relative to 'root',
+    with a trailing slash) are not recorded.  If 'threads' is given, the
+    top level directories are scanned in parallel."""
+    root = root.rstrip("/")
+    skip = set(skip)
+    if threads:
+        scanned, subdirs = scan_directory(root, "/", skip, recursive=False)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for result, unscanned in executor.map(lambda d: scan_directory(root, d, skip), sorted(subdirs)):
+                scanned.extend(result)
+    else:
+        scanned, unscanned = scan_directory(root, "/", skip)
+    tree = TreeMetaData(uidmap, gidmap)
+    for name, st, target in scanned:
+        tree.add(name, st.st_mode, st.st_uid, st.st_gid, st.st_size, target)
+    return tree
+
+
+def processes_in_directory(path, pids=None):
+    """Return a list of (pid, description) for the processes whose root or
+    current working directory is 'path' or below.  If 'pids' is given, only
+    these processes are checked, otherwise all processes in /proc."""
+    path = os.path.realpath(path)
+    if pids is None:
+        pids = sorted(int(name) for name in os.listdir("/proc") if name.isdigit())
+    processes = []
+    for pid in pids:
+        if pid == os.getpid():
+            continue
+        links = []
+        for link in ("root", "cwd"):
+            try:
+                target = os.readlink("/proc/%d/%s" % (pid, link))
+            except OSError:
+                continue
+            if target == path or target.startswith(path + "/"):
+                links.append("%s=%s" % (link, target))
+        if links:
+            try:
+                with open("/proc/%d/cmdline" % pid, "rb") as f:
+                    cmdline = f.read().rstrip(b"\0").replace(b"\0", b" ").decode(errors="replace")
+            except OSError:
+                cmdline = ""
+            processes.append((pid, "%s (%s)" % (cmdline, ", ".join(links))))
+    return processes
+
+
+class FileLock:
+
+    """An exclusive flock() on a file, to be used as a context manager."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.fd = None
+
+    def __enter__(self):
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.close(self.fd)
+        self.fd = None
+
+
+def evict_apt_archive_cache(pool, max_size):
+    """Remove the least recently used packages from the shared archive cache
+    until its size is at most max_size bytes.  Files are used through the
+    overlay mounts without being modified, so the access time (or the time
+    they were added) is taken as the time of last use."""
+    entries = []
+    for entry in os.scandir(pool):
+        if entry.name.endswith(".deb") and entry.is_file(follow_symlinks=False):
+            st = entry.stat(follow_symlinks=False)
+            entries.append((max(st.st_atime, st.st_mtime), st.st_size, entry.path))
+    total = sum(size for (used, size, path) in entries)
+    for used, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        logging.debug("Evicting %s from the apt archive cache" % os.path.basename(path))
+        os.remove(path)
+        total -= size
+
 
 class Chroot:
 
@@ -772,6 +1248,16 @@ class Chroot:
         self.mounts = []
         self.initial_selections = None
         self.avail_md5_history = []
+        self.use_tmpfs = settings.tmpfs_size is not None and not settings.lvm_volume and \
+            not settings.schroot and not settings.docker_image
+        self.tmpfs = False
+        self.file_owners = {}
+        self.dpkg_list_files = {}
+        self.agent = None
+        self.apt_archives_upper = None
+        self.apt_archives_snapshot = None
+        self.saved_apt_archives = set()
+        self.overlay_layer = None
 
     def create_temp_dir(self):
         """Create a temporary directory for the chroot."""
@@ -779,9 +1265,24 @@ class Chroot:
         create_file(os.path.join(self.name, ".piuparts.tmpdir"), "chroot")
         os.chmod(self.name, 0o755)
         logging.debug("Created temporary directory %s" % self.name)
-
-    def create(self, temp_tgz=None):
-        """Create a chroot according to user's wishes."""
+        if self.use_tmpfs:
+            self.mount_tmpfs()
+
+    def mount_tmpfs(self):
+        """Mount a size-limited tmpfs over the chroot directory."""
+        run(["mount", "-t", "tmpfs", "-o", "size=%s,mode=0755" % settings.tmpfs_size,
+             "piuparts-tmpfs", self.name])
+        self.mounts.append(self.name)
+        self.tmpfs = True
+        create_file(os.path.join(self.name, ".piuparts.tmpdir"), "chroot on tmpfs")
+        logging.debug("Mounted tmpfs (size=%s) on %s" % (settings.tmpfs_size, self.name))
+
+    def create(self, temp_tgz=None, packages=None, package_files=None):
+        """Create a chroot according to user's wishes.
+
+        If 'packages' is given, check whether they fit into the tmpfs of the
+        chroot right after the apt update and return False without
+        finishing the setup if they don't."""
         self.panic_handler_id = do_on_panic(self.remove)
         if not settings.schroot and not settings.docker_image:
             self.create_temp_dir()
@@ -824,8 +1325,12 @@ class Chroot:
 
         self.aptupdate_run()
 
+        if packages is not None and not self.fits_into_tmpfs(packages, package_files):
+            return False
+
         if settings.basetgz or settings.docker_image or settings.schroot or settings.existing_chroot:
-            self.run(["apt-get", "-yf", "dist-upgrade"])
+            with PhaseTimer("base-upgrade"):
+                self.run(["apt-get", "-yf", "dist-upgrade"])
         self.minimize()
         self.remember_available_md5()
 
@@ -837,12 +1342,55 @@ class Chroot:
         if settings.savetgz and not temp_tgz:
             self.pack_into_tgz(settings.savetgz)
 
+        return True
+
+    def freeze(self):
+        """Unmount everything from the chroot, so it can serve as the
+        read-only base of overlay chroots.  Only the tmpfs the chroot itself
+        may live on stays mounted."""
+        self.check_for_no_processes(fail=True)
+        self.save_apt_archives()
+        self.stop_agent()
+        for mountpoint in reversed(self.mounts):
+            if mountpoint != self.name:
+                run(["umount", mountpoint], ignore_errors=True)
+        self.mounts = [mountpoint for mountpoint in self.mounts if mountpoint == self.name]
+
+    def create_overlay(self, base):
+        """Create a chroot as a copy-on-write overlay of the frozen 'base'
+        chroot.  All changes end up in a private upper layer that is thrown
+        away by remove(), the base chroot stays unchanged."""
+        self.panic_handler_id = do_on_panic(self.remove)
+        self.use_tmpfs = False
+        self.create_temp_dir()
+        self.overlay_layer = tempfile.mkdtemp(dir=settings.tmpdir)
+        upper = os.path.join(self.overlay_layer, "upper")
+        work = os.path.join(self.overlay_layer, "work")
+        os.mkdir(upper, 0o755)
+        os.mkdir(work, 0o755)
+        run(["mount", "-t", "overlay", "-o",
+             "lowerdir=%s,upperdir=%s,workdir=%s" % (base.name, upper, work),
+             "piuparts-overlay", self.name])
+        self.mounts.append(self.name)
+        logging.debug("Mounted overlay of %s on %s" % (base.name, self.name))
+        self.initial_selections = base.initial_selections
+        self.avail_md5_history = list(base.avail_md5_history)
+        self.mount_proc()
+        self.configure_chroot()
+
     def remove(self):
         """Remove a chroot and all its contents."""
+        self.save_apt_archives()
         if not settings.keep_env and os.path.exists(self.name):
             self.terminate_running_processes()
             self.unmount_all()
-            if settings.lvm_volume:
+            if self.apt_archives_upper is not None:
+                shutil.rmtree(os.path.dirname(self.apt_archives_upper))
+                self.apt_archives_upper = None
+            if self.apt_archives_snapshot is not None:
+                shutil.rmtree(self.apt_archives_snapshot)
+                self.apt_archives_snapshot = None
+            if settings.lvm_volume and self.overlay_layer is None:
                 logging.debug('Unmounting and removing LVM snapshot %s' % self.lvm_snapshot_name)
                 run(['umount', self.name])
                 run(['lvremove', '-f', self.lvm_snapshot])
@@ -857,6 +1405,9 @@ class Chroot:
                 if os.path.exists(self.name):
                     create_file(os.path.join(self.name, ".piuparts.tmpdir"), "removal failed")
                 logging.debug("Removed directory tree at %s" % self.name)
+                if self.overlay_layer is not None:
+                    run(['rm', '-rf', '--one-file-system', self.overlay_layer])
+                    self.overlay_layer = None
         elif settings.keep_env:
             if settings.schroot:
                 logging.debug("Keeping schroot session %s at %s" % (self.schroot_session, self.name))
@@ -864,6 +1415,8 @@ class Chroot:
                 logging.debug("Keeping container %s" % self.docker_container)
             else:
                 logging.debug("Keeping directory tree at %s" % self.name)
+                if self.tmpfs:
+                    logging.debug("The chroot is on a tmpfs, unmount it with 'umount %s'" % self.name)
         dont_do_on_panic(self.panic_handler_id)
 
     def was_bootstrapped(self):
@@ -883,8 +1436,10 @@ class Chroot:
         # the interface for Chroot allows the VirtServ hack to work.
         remove_files([temp_tgz])
 
+    @timed("pack")
     def pack_into_tgz(self, result):
         """Tar and compress all files in the chroot."""
+        self.save_apt_archives()
         self.run(["apt-get", "clean"])
         logging.debug("Saving %s to %s." % (self.name, result))
 
@@ -899,6 +1454,7 @@ class Chroot:
         os.rename(tmpfile, result)
         dont_do_on_panic(panic_handler_id)
 
+    @timed("unpack")
     def unpack_from_tgz(self, tarball):
         """Unpack a tarball to a chroot."""
         logging.debug("Unpacking %s into %s" % (tarball, self.name))
@@ -969,25 +1525,33 @@ class Chroot:
         except:
             pass
 
+    def chroot_command(self, command, interactive=False):
+        """Return the command line that runs command inside the chroot."""
+        if settings.schroot:
+            return ["schroot", "--preserve-environment", "--run-session", "--chroot", "session:" +
+                    self.schroot_session, "--directory", "/", "-u", "root", "--"] + command
+        elif settings.docker_image:
+            return ['docker', 'exec'] + (['-i'] if interactive else []) + [self.docker_container] + command
+        else:
+            return ["chroot", self.name] + command
+
     def run(self, command, ignore_errors=False):
         prefix = []
         if settings.eatmydata and os.path.isfile(os.path.join(self.name,
                                                  'usr/bin/eatmydata')):
             prefix.append('eatmydata')
-        if settings.schroot:
-            return run(
-                ["schroot", "--preserve-environment", "--run-session", "--chroot", "session:" +
-                    self.schroot_session, "--directory", "/", "-u", "root", "--"] + prefix + command,
+        if settings.chroot_agent:
+            if self.agent is None:
+                self.agent = ChrootAgent(self.chroot_command(["sh"], interactive=True))
+            return self.agent.run(prefix + command, self.chroot_command(prefix + command),
+                                  ignore_errors=ignore_errors, timeout=settings.max_command_runtime)
+        return run(self.chroot_command(prefix + command),
                    ignore_errors=ignore_errors, timeout=settings.max_command_runtime)
-        elif settings.docker_image:
-            return run(
-                ['docker', 'exec', self.docker_container,] + prefix + command,
-                ignore_errors=ignore_errors,
-                timeout=settings.max_command_runtime,
-            )
-        else:
-            return run(["chroot", self.name] + prefix + command,
-                       ignore_errors=ignore_errors, timeout=settings.max_command_runtime)
+
+    def stop_agent(self):
+        """Stop the chroot agent, it is restarted by the next run()."""
+        if self.agent is not None:
+            self.agent.stop()
 
     def mkdir_p(self, path):
         fullpath = self.relative(path)
@@ -1008,15 +1572,87 @@ class Chroot:
                     "\n".join(lines) + "\n")
         logging.debug("sources.list:\n" + indent_string("\n".join(lines)))
 
+    @timed("apt-update")
     def aptupdate_run(self):
         """Resynchronize the package index files.
            If executed under --update-retries <num>, retry
            its execution up to <num> times, useful e.g.
            on temporary network failures or hashsum mismatch
-           errors."""
+           errors.
+           With --apt-lists-cache, reuse recent package index
+           files for the same apt configuration instead."""
+        if settings.apt_lists_cache:
+            key = self.apt_lists_cache_key()
+            if key is not None:
+                return self.aptupdate_from_cache(key)
+        return self.apt_get_update()
+
+    def apt_lists_cache_key(self):
+        """Return the key of the package index files for the apt sources and
+        configuration of the chroot, or None if they must not be cached."""
+        if os.path.exists(self.relative("etc/apt/sources.list.d/piuparts-testdebs-repo.list")):
+            # the packages to be tested change between runs
+            return None
+        h = hashlib.sha256()
+        if settings.arch:
+            h.update(settings.arch.encode())
+        for pattern in ["etc/apt/sources.list", "etc/apt/sources.list.d/*",
+                        "etc/apt/apt.conf.d/*", "var/lib/dpkg/arch"]:
+            for filename in sorted(glob.glob(self.relative(pattern))):
+                if not os.path.isfile(filename):
+                    continue
+                with open(filename, "rb") as f:
+                    content = f.read()
+                if filename.startswith(self.relative("etc/apt/sources.list")) and \
+                        re.search(rb"^[^#]*\b(file|copy):", content, re.M):
+                    # local repositories (like --testdebs-repo) change
+                    # between tests, and updating them is cheap anyway
+                    return None
+                h.update(filename[len(self.name):].encode() + b"\0" + content + b"\0")
+        return h.hexdigest()
+
+    def aptupdate_from_cache(self, key):
+        """Copy the package index files from the shared cache into the chroot
+        if they are recent enough, otherwise run 'apt-get update' and store
+        the result in the cache.  Concurrent runs for the same key wait for
+        each other, so only one of them updates."""
+        if not os.path.isdir(settings.apt_lists_cache):
+            os.makedirs(settings.apt_lists_cache)
+        entry = os.path.join(settings.apt_lists_cache, key)
+        lists = self.relative("var/lib/apt/lists")
+        skip = shutil.ignore_patterns("lock", "partial")
+        with FileLock(entry + ".lock"):
+            stamp = os.path.join(entry, "stamp")
+            if os.path.exists(stamp) and \
+                    time.time() - os.path.getmtime(stamp) < settings.apt_lists_cache_max_age * 60:
+                logging.debug("Using package lists from %s" % entry)
+                for name in os.listdir(lists):
+                    if name not in ("lock", "partial"):
+                        path = os.path.join(lists, name)
+                        if os.path.isdir(path) and not os.path.islink(path):
+                            shutil.rmtree(path)
+                        else:
+                            os.remove(path)
+                shutil.copytree(os.path.join(entry, "lists"), lists, symlinks=True,
+                                ignore=skip, dirs_exist_ok=True)
+                return 0
+            status = self.apt_get_update()
+            if status:
+                return status
+            tmpdir = tempfile.mkdtemp(dir=settings.apt_lists_cache)
+            shutil.copytree(lists, os.path.join(tmpdir, "lists"), symlinks=True, ignore=skip)
+            create_file(os.path.join(tmpdir, "stamp"), "")
+            if os.path.exists(entry):
+                shutil.rmtree(entry)
+            os.rename(tmpdir, entry)
+            logging.debug("Stored package lists in %s" % entry)
+        return 0
+
+    def apt_get_update(self):
+        """Run 'apt-get update', retrying it if requested."""
         if not settings.update_retries:
             self.run(["apt-get", "update"])
-            return
+            return 0
 
         count = 0
         for count, run in enumerate(range(settings.update_retries), 1):
@@ -1127,6 +1763,7 @@ class Chroot:
         os.chmod(full_name, 0o644)
         logging.debug("Created resolv.conf.")
 
+    @timed("debootstrap")
     def setup_minimal_chroot(self):
         """Set up a minimal Debian system in a chroot."""
         logging.debug("Setting up minimal chroot for %s at %s." %
@@ -1152,6 +1789,7 @@ class Chroot:
             [settings.debian_distros[0], self.name, settings.distro_config.get_mirror(settings.debian_distros[0])])
         self.bootstrapped = True
 
+    @timed("minimize")
     def minimize(self):
         """Minimize a chroot by removing (almost all) unnecessary packages"""
         if settings.skip_minimize or not settings.minimize:
@@ -1175,6 +1813,8 @@ class Chroot:
         self.create_resolv_conf()
         for bindmount in settings.bindmounts:
             self.mount(bindmount, bindmount, opts="bind")
+        if settings.apt_archive_cache and not settings.schroot and not settings.docker_image:
+            self.mount_apt_archive_cache()
         if not os.path.exists(self.name + '/dev/null'):
             run(['mknod', '-m' ,'666', self.name + '/dev/null', 'c', '1', '3'])
 
@@ -1220,16 +1860,32 @@ class Chroot:
         """Does apt-get (or apt-cache) know about a set of packages?"""
         known_packages = []
         new_packages = []
-        for name in packages:
-            (status, output) = self.run(["apt-cache", "show", "--no-all-versions", name],
+        available = set()
+        if packages:
+            # Query all packages at once and map the stanzas back to the
+            # requested names. Diagnostics for unknown packages go to stderr,
+            # keep them from being interleaved with the stanzas.
+            (status, output) = self.run(["sh", "-c", 'apt-cache show --no-all-versions "$@" 2>/dev/null', "sh"] + packages,
                                         ignore_errors=True)
-            # apt-cache reports status for some virtual packages and packages
-            # in status config-files-remaining state without installation
-            # candidate -- but only real packages have Filename/MD5sum/SHA*
-            if status != 0 or re.search(r'^(Filename|MD5sum|SHA1|SHA256):', output, re.M) is None:
-                new_packages.append(name)
-            else:
+            for stanza in output.split("\n\n"):
+                # apt-cache reports status for some virtual packages and packages
+                # in status config-files-remaining state without installation
+                # candidate -- but only real packages have Filename/MD5sum/SHA*
+                if re.search(r'^(Filename|MD5sum|SHA1|SHA256):', stanza, re.M) is None:
+                    continue
+                fields = dict(re.findall(r'^(Package|Architecture):[ \t]*(\S+)', stanza, re.M))
+                if "Package" in fields:
+                    available.add(fields["Package"])
+                    available.add("%s:%s" % (fields["Package"], fields.get("Architecture")))
+        for name in packages:
+            if name not in available and self.apt_cache_knows(name):
+                # queries like pkg=version, pkg/suite or pkg:arch of an
+                # Architecture: all package can't be mapped back
+                available.add(name)
+            if name in available:
                 known_packages.append(name)
+            else:
+                new_packages.append(name)
         if not known_packages:
             logging.info("apt-cache does not know about any of the requested packages")
         else:
@@ -1240,6 +1896,106 @@ class Chroot:
                              ", ".join(new_packages))
         return known_packages
 
+    def apt_cache_knows(self, name):
+        """Does apt-cache know about a single package?"""
+        (status, output) = self.run(["apt-cache", "show", "--no-all-versions", name],
+                                    ignore_errors=True)
+        return status == 0 and re.search(r'^(Filename|MD5sum|SHA1|SHA256):', output, re.M) is not None
+
+    def mount_apt_archive_cache(self):
+        """Mount a snapshot of the shared apt archive cache as the read-only
+        lower layer of an overlay on /var/cache/apt/archives.  Packages
+        downloaded in the chroot (and apt's lock file) end up in a private
+        upper layer, so concurrent tests never write to the shared cache
+        directly.  The lower layer of an overlay must not change while it is
+        mounted, so it is a private directory of hard links to the packages
+        in the cache, which other tests may add to or evict from."""
+        pool = os.path.join(settings.apt_archive_cache, "archives")
+        snapshots = os.path.join(settings.apt_archive_cache, "snapshots")
+        for path in [pool, snapshots]:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self.apt_archives_snapshot = tempfile.mkdtemp(dir=snapshots)
+        os.chmod(self.apt_archives_snapshot, 0o755)
+        with FileLock(os.path.join(settings.apt_archive_cache, "lock")):
+            for entry in os.scandir(pool):
+                if entry.name.endswith(".deb") and entry.is_file(follow_symlinks=False):
+                    os.link(entry.path, os.path.join(self.apt_archives_snapshot, entry.name))
+        overlay = tempfile.mkdtemp(dir=settings.tmpdir)
+        self.apt_archives_upper = os.path.join(overlay, "upper")
+        os.mkdir(self.apt_archives_upper, 0o755)
+        os.mkdir(os.path.join(overlay, "work"), 0o755)
+        self.mount("overlay", "/var/cache/apt/archives", fstype="overlay",
+                   opts="lowerdir=%s,upperdir=%s,workdir=%s" % (self.apt_archives_snapshot,
+                                                                 self.apt_archives_upper,
+                                                                 os.path.join(overlay, "work")))
+
+    def save_apt_archives(self):
+        """Add the packages downloaded into the chroot to the shared apt
+        archive cache and evict old ones if it grew too large.  The files are
+        copied under a lock and renamed into place, so other tests only ever
+        see complete files.  apt verifies each cached package against the
+        hashes from the package index before using it."""
+        if self.apt_archives_upper is None:
+            return
+        pool = os.path.join(settings.apt_archive_cache, "archives")
+        with FileLock(os.path.join(settings.apt_archive_cache, "lock")):
+            for entry in os.scandir(self.apt_archives_upper):
+                if not entry.name.endswith(".deb") or not entry.is_file(follow_symlinks=False):
+                    continue
+                st = entry.stat(follow_symlinks=False)
+                identity = (entry.name, st.st_size, st.st_mtime_ns)
+                if identity in self.saved_apt_archives:
+                    continue
+                self.saved_apt_archives.add(identity)
+                target = os.path.join(pool, entry.name)
+                if os.path.isfile(target) and os.path.getsize(target) == st.st_size:
+                    continue
+                (fd, tmpfile) = tempfile.mkstemp(dir=pool, prefix=".piuparts-")
+                os.close(fd)
+                shutil.copyfile(entry.path, tmpfile)
+                os.chmod(tmpfile, 0o644)
+                os.rename(tmpfile, target)
+                logging.debug("Added %s to the apt archive cache" % entry.name)
+            if settings.apt_archive_cache_size:
+                evict_apt_archive_cache(pool, settings.apt_archive_cache_size * 1024 * 1024)
+
+    def get_installed_size(self, packages, package_files):
+        """Estimate the Installed-Size (in KiB) of the packages to be tested
+        and all the packages apt would install together with them."""
+        size = 0
+        names = unqualify(packages)
+        for package_file in package_files:
+            (status, output) = run(["dpkg-deb", "-f", package_file, "Installed-Size"], ignore_errors=True)
+            if status == 0 and output.strip().isdigit():
+                size += int(output)
+        # For package files this resolves the dependencies of the archive
+        # version (if any), which is close enough for an estimate.
+        (status, output) = self.run(["apt-get", "-s", "install"] + names, ignore_errors=True)
+        to_install = re.findall(r"^Inst (\S+)", output, re.M)
+        if package_files:
+            to_install = [p for p in to_install if p.split(":")[0] not in names]
+        if to_install:
+            (status, output) = self.run(["apt-cache", "show", "--no-all-versions"] + to_install,
+                                        ignore_errors=True)
+            size += sum([int(x) for x in re.findall(r"^Installed-Size: (\d+)", output, re.M)])
+        return size
+
+    def fits_into_tmpfs(self, packages, package_files):
+        """Will the packages to be tested fit into the tmpfs of this chroot?"""
+        if not self.tmpfs:
+            return True
+        size = self.get_installed_size(packages, package_files)
+        if settings.tmpfs_max_installed_size:
+            limit = settings.tmpfs_max_installed_size * 1024
+        else:
+            # leave room for the downloaded .debs and dpkg's temporary files
+            vfs = os.statvfs(self.name)
+            limit = vfs.f_bavail * vfs.f_frsize // 1024 // 2
+        logging.debug("Estimated Installed-Size of packages and dependencies: %d KiB (tmpfs limit: %d KiB)" %
+                      (size, limit))
+        return size <= limit
+
     def copy_files(self, source_names, target_name):
         """Copy files in 'source_name' to file/dir 'target_name', relative
         to the root of the chroot."""
@@ -1278,12 +2034,16 @@ class Chroot:
     def is_installed(self, packages):
         if not packages:
             return True
-        retcode, output = self.run(["dpkg-query", "-f", "${Package} ${Status}\n", "-W"] + packages, ignore_errors=True)
-        if retcode != 0:
+        statuses = self.get_package_statuses(packages)
+        if statuses is None:
+            retcode, output = self.run(["dpkg-query", "-f", "${Package} ${Status}\n", "-W"] + packages, ignore_errors=True)
+            if retcode != 0:
+                return False
+            statuses = [line.split() for line in output.splitlines()]
+        elif not all(statuses):
             return False
         installed = True
-        for line in output.splitlines():
-            pkg, desired, whatever, status = line.split()
+        for pkg, desired, whatever, status in statuses:
             if status != 'installed':
                 logging.error("Installation of %s failed", pkg)
                 installed = False
@@ -1306,8 +2066,7 @@ class Chroot:
             #   `dpkg -i foo.deb && apt-get -yf install`
             # approach since 'apt-get -yf install' can 'resolve' dependency
             # problems by removing the package we are trying to install
-            (status, output) = self.run(["dpkg-query", "-f", "${Version}\n", "-W", "apt"], ignore_errors=True)
-            apt_can_install_debs = apt_pkg.version_compare(output.strip(), "1.1") >= 0
+            apt_can_install_debs = apt_pkg.version_compare(self.get_package_version("apt"), "1.1") >= 0
 
             # This must look like a local path so that apt-get can
             # distinguish it from a 'package/suite' request.
@@ -1391,8 +2150,89 @@ class Chroot:
         command.extend(["%s_" % x for x in unqualify(to_purge)])
         self.run(command)
 
+    def read_dpkg_status(self):
+        """Parse the dpkg status file of the chroot in-process.
+
+        Returns a list of Package objects, one per stanza, or None if the
+        database cannot be used directly (unreadable status file, pending
+        entries in the updates journal, no native architecture known), in
+        which case the callers fall back to running dpkg-query."""
+        if os.path.isdir(self.relative("var/lib/dpkg/updates")) and \
+                any(name.isdigit() for name in os.listdir(self.relative("var/lib/dpkg/updates"))):
+            return None
+        entries = []
+        try:
+            with open(self.relative("var/lib/dpkg/status"), encoding="utf-8", errors="replace") as f:
+                content = f.read()
+            f = io.StringIO(content)
+            # stray empty lines end a stanza, but not the file
+            while f.tell() < len(content):
+                headers = rfc822_like_header_parse(f)
+                if headers:
+                    p = Package(headers)
+                    if "Package" in p and "Status" in p:
+                        entries.append(p)
+        except (IOError, ValueError):
+            return None
+        if not any(p.get("Package") == "dpkg" and "Architecture" in p for p in entries):
+            return None
+        return entries
+
+    def get_package_statuses(self, packages):
+        """Return [package, want, flag, state] for each package, like dpkg-query -W.
+
+        A None entry is returned for packages unknown to dpkg.
+        Returns None if the status file cannot be used directly."""
+        if any(c in p for p in packages for c in "*?[]\\"):
+            return None
+        entries = self.read_dpkg_status()
+        if entries is None:
+            return None
+        statuses = []
+        for spec in packages:
+            name, _, arch = spec.partition(":")
+            matches = [p for p in entries if p.get("Package") == name and
+                       (not arch or p.get("Architecture") == arch)]
+            if not matches:
+                statuses.append(None)
+            for p in matches:
+                statuses.append([name] + p.get("Status", "").split())
+        return statuses
+
+    def get_package_version(self, package):
+        """Return the version of a package known to dpkg or an empty string."""
+        entries = self.read_dpkg_status()
+        if entries is None:
+            (status, output) = self.run(["dpkg-query", "-f", "${Version}\n", "-W", package], ignore_errors=True)
+            return output.strip()
+        for p in entries:
+            if p.get("Package") == package:
+                return p.get("Version", "")
+        return ""
+
     def get_selections(self):
         """Get current package selections in a chroot."""
+        entries = self.read_dpkg_status()
+        if entries is not None:
+            # the architecture of dpkg itself is the native one
+            native = [p["Architecture"] for p in entries if p.get("Package") == "dpkg"][0]
+            vdict = {}
+            for p in entries:
+                (status, flag, state) = p["Status"].split()
+                if state == "not-installed":
+                    continue
+                # mimic "${binary:Package}", which qualifies Multi-Arch: same
+                # and foreign architecture packages
+                name = p["Package"]
+                arch = p.get("Architecture", "")
+                if p.get("Multi-Arch") == "same" or arch not in ("", "all", native):
+                    name = "%s:%s" % (name, arch)
+                if status == "install":
+                    version = p.get("Version", "")
+                else:
+                    version = None
+                vdict[name] = (status, version)
+            return vdict
         # "${Status}" emits three columns, e.g. "install ok installed"
         # "${binary:Package}" requires a multi-arch dpkg, so fall back to "${Package}" on older versions
         (status, output) = self.run(["dpkg-query", "-W", "-f", "${Status}\\t${binary:Package}\\t${Package}\\t${Version}\\n"])
@@ -1423,6 +2263,7 @@ class Chroot:
         added = [ln for ln in post_install_diversions if not ln in pre_install_diversions]
         return (removed, added)
 
+    @timed("debsums")
     def check_debsums(self):
         (status, output) = run(["debsums", "--root", self.name, "-ac", "--ignore-obsolete"], ignore_errors=True)
         if status != 0:
@@ -1431,6 +2272,7 @@ class Chroot:
             if not settings.warn_on_debsums_errors:
                 panic()
 
+    @timed("adequate")
     def check_adequate(self, packages):
         """Run adequate and categorize output according to our needs. """
         packages = unqualify([p for p in packages if not p.endswith("=None")])
@@ -1490,14 +2332,26 @@ class Chroot:
                 if not settings.warn_if_inadequate:
                     panic()
 
-    def list_paths_with_symlinks(self):
+    def list_paths_with_symlinks(self, scan=None):
+        """Check for files installed via directory symlinks.  If 'scan' (the
+        result of scan() on the current chroot) is given, directories found
+        in its tree are known to contain no symlinks and need no
+        canonicalization, and its path_cache is reused."""
         file_owners = self.get_files_owned_by_packages()
+        if scan is not None:
+            tree = scan.tree
+            path_cache = scan.path_cache
+        else:
+            tree = {}
+            path_cache = {}
         bad = []
         overwrites = False
         usrmerge = set()
         for f in sorted(file_owners.keys()):
             dn, fn = os.path.split(f)
-            dc = canonicalize_path(self.name, dn)
+            if os.path.join(dn, "") in tree:
+                continue
+            dc = canonicalize_path(self.name, dn, cache=path_cache)
             if dn != dc:
                 # Allow the /usr merge to have taken place. For example, if
                 # f (the file recorded in the dpkg database) is /bin/cat,
@@ -1546,16 +2400,17 @@ class Chroot:
         if packages:
             self.run(["dpkg", "--purge"] + unqualify(packages), ignore_errors=ignore_errors)
 
-    def restore_selections(self, reference_chroot_state, packages_qualified):
+    def restore_selections(self, reference_chroot_state, packages_qualified, scan=None):
         """Restore package selections in a chroot to the state in
-        'reference_chroot_state'."""
+        'reference_chroot_state'.  'scan' may be the result of scan()
+        on the current chroot."""
 
         if reference_chroot_state["avail_md5"] != self.avail_md5_history:
             logging.warn("History of available packages does not match - reference chroot may be outdated")
             logging.debug(" reference: %s" % " ".join(reference_chroot_state["avail_md5"]))
             logging.debug(" current  : %s" % " ".join(self.avail_md5_history))
 
-        self.list_paths_with_symlinks()
+        self.list_paths_with_symlinks(scan=scan)
         self.check_debsums()
         self.check_adequate(packages_qualified)
 
@@ -1589,21 +2444,22 @@ class Chroot:
                            if state == "install"]
 
         # First remove all packages (and reinstall missing ones).
-        self.remove_packages(deps_to_remove)
-        if all_to_install:
-            version_qualified = [name for (name, version) in all_to_install
-                                 if version is None]
-            version_qualified += ["%s=%s" % (name, version) for (name, version) in all_to_install
-                                  if version is not None]
-            self.apt_get_install(to_remove=all_to_remove,
-                                 to_install=version_qualified,
-                                 flags=["--no-install-recommends", "--force-yes"])
-            # reinstall potentially downgraded packages, they may have
-            # missing files in case of unfortunate Breaks+Replaces timing
-            self.apt_get_install(to_install=version_qualified,
-                                 flags=["--no-install-recommends", "--reinstall"])
-        else:
-            self.remove_packages(all_to_remove)
+        with PhaseTimer("purge"):
+            self.remove_packages(deps_to_remove)
+            if all_to_install:
+                version_qualified = [name for (name, version) in all_to_install
+                                     if version is None]
+                version_qualified += ["%s=%s" % (name, version) for (name, version) in all_to_install
+                                      if version is not None]
+                self.apt_get_install(to_remove=all_to_remove,
+                                     to_install=version_qualified,
+                                     flags=["--no-install-recommends", "--force-yes"])
+                # reinstall potentially downgraded packages, they may have
+                # missing files in case of unfortunate Breaks+Replaces timing
+                self.apt_get_install(to_install=version_qualified,
+                                     flags=["--no-install-recommends", "--reinstall"])
+            else:
+                self.remove_packages(all_to_remove)
 
         # Run custom scripts after removing all packages.
         self.run_scripts("post_remove")
@@ -1620,11 +2476,12 @@ class Chroot:
                 self.check_output_logrotatefiles(logrotatefiles)
                 self.purge_packages(installed)
 
-        # Then purge all packages being depended on.
-        self.purge_packages(deps_to_purge)
+        with PhaseTimer("purge"):
+            # Then purge all packages being depended on.
+            self.purge_packages(deps_to_purge)
 
-        # Finally, purge actual packages.
-        self.purge_packages(nondeps_to_purge)
+            # Finally, purge actual packages.
+            self.purge_packages(nondeps_to_purge)
 
         # Run custom scripts after purge all packages.
         self.run_scripts("post_purge")
@@ -1633,11 +2490,12 @@ class Chroot:
         self.run(["dpkg", "--purge", "--pending"])
         self.run(["dpkg", "--remove", "--pending"])
 
-    def get_tree_meta_data(self):
+    @timed("scan")
+    def get_tree_meta_data(self, clean=True):
         """Return the filesystem meta data for all objects in the chroot."""
-        self.run(["apt-get", "clean"])
+        if clean and self.apt_archives_upper is None:
+            self.run(["apt-get", "clean"])
         logging.debug("Recording chroot state")
-        root = self.relative(".")
         uidmap = {}
         with open(self.relative("etc/passwd"), "r") as passwd:
             for line in passwd:
@@ -1648,34 +2506,37 @@ class Chroot:
             for line in group:
                 (grp, x, gid) = line.split(":")[0:3]
                 gidmap[int(gid)] = grp
-        vdict = {}
-        proc = os.path.join(root, "proc")
-        devpts = os.path.join(root, "dev/pts")
-        for dirpath, dirnames, filenames in os.walk(root):
-            assert dirpath[:len(root)] == root
-            if dirpath[:len(proc) + 1] in [proc, proc + "/"]:
-                continue
-            if dirpath[:len(devpts) + 1] in [devpts, devpts + "/"]:
-                continue
-            for name in [dirpath] + \
-                        [os.path.join(dirpath, f) for f in filenames]:
-                st = os.lstat(name)
-                if stat.S_ISLNK(st.st_mode):
-                    target = os.readlink(name)
-                else:
-                    target = None
-                    if stat.S_ISDIR(st.st_mode):
-                        name += "/"
-                if st.st_uid in uidmap:
-                    user = uidmap[st.st_uid]
-                else:
-                    user = "#%d" % st.st_uid
-                if st.st_gid in gidmap:
-                    group = gidmap[st.st_gid]
-                else:
-                    group = "#%d" % st.st_gid
-                vdict[name[len(root):]] = FileInfo(st, target, user, group)
-        return vdict
+        if self.apt_archives_upper is None:
+            return scan_tree_meta_data(self.name, uidmap, gidmap,
+                                       skip=["/proc/", "/dev/pts/"],
+                                       threads=settings.tree_scan_threads)
+        # Downloaded packages are kept for the shared archive cache instead
+        # of running 'apt-get clean'. Only record the directory itself, its
+        # contents would be the lock and the empty partial/ after cleaning.
+        self.save_apt_archives()
+        archives = "/var/cache/apt/archives/"
+        tree = scan_tree_meta_data(self.name, uidmap, gidmap,
+                                   skip=["/proc/", "/dev/pts/", archives],
+                                   threads=settings.tree_scan_threads)
+        st = os.lstat(self.relative(archives))
+        tree.add(archives, st.st_mode, st.st_uid, st.st_gid, st.st_size, None)
+        return tree
+
+    def scan(self, clean=True):
+        """Scan the chroot once and return a ChrootScan with the filesystem
+        meta data and the list of broken symlinks.  The symlinks are taken
+        from the recorded meta data, so this needs no second walk over the
+        tree.  The path_cache of resolved directories can be used for
+        further canonicalize_path() calls until the chroot is modified."""
+        tree = self.get_tree_meta_data(clean=clean)
+        broken = []
+        path_cache = {}
+        if settings.check_broken_symlinks:
+            for name in tree.symlinks():
+                if is_broken_symlink(self.name, os.path.dirname(name), os.path.basename(name),
+                                     cache=path_cache):
+                    broken.append(name)
+        return ChrootScan(tree, broken, path_cache)
 
     def get_state_meta_data(self):
         chroot_state = {}
@@ -1692,28 +2553,51 @@ class Chroot:
         return os.path.join(self.name, pathname)
 
     def get_files_owned_by_packages(self):
-        """Return dict[filename] = [packagenamelist]."""
+        """Return dict[filename] = [packagenamelist].
+
+        The ownership index is kept between calls, only the .list files
+        that were added, modified or removed since the last call are
+        processed again.  The lists in the returned dict are never
+        modified afterwards, so earlier results remain valid."""
         vdir = self.relative("var/lib/dpkg/info")
-        vdict = {}
-        for basename in os.listdir(vdir):
-            if basename.endswith(".list"):
-                pkg = basename[:-len(".list")]
-                for line in readlines_file(os.path.join(vdir, basename)):
-                    pathname = line.strip()
-                    if pathname in vdict:
-                        vdict[pathname].append(pkg)
+        current = {}
+        for entry in os.scandir(vdir):
+            if entry.name.endswith(".list"):
+                st = entry.stat()
+                current[entry.name] = (st.st_mtime_ns, st.st_size, st.st_ino)
+        for basename in list(self.dpkg_list_files):
+            if current.get(basename) != self.dpkg_list_files[basename][0]:
+                (identity, pkg, pathnames) = self.dpkg_list_files.pop(basename)
+                # a .list file may contain a path more than once
+                for pathname in set(pathnames):
+                    owners = [p for p in self.file_owners[pathname] if p != pkg]
+                    if owners:
+                        self.file_owners[pathname] = owners
                     else:
-                        vdict[pathname] = [pkg]
-        return vdict
+                        del self.file_owners[pathname]
+        for basename, identity in current.items():
+            if basename not in self.dpkg_list_files:
+                pkg = sys.intern(basename[:-len(".list")])
+                pathnames = [sys.intern(line.strip())
+                             for line in readlines_file(os.path.join(vdir, basename))]
+                self.dpkg_list_files[basename] = (identity, pkg, pathnames)
+                for pathname in pathnames:
+                    if pathname in self.file_owners:
+                        self.file_owners[pathname] = self.file_owners[pathname] + [pkg]
+                    else:
+                        self.file_owners[pathname] = [pkg]
+        return dict(self.file_owners)
 
     def check_for_no_processes(self, fail=None):
         """Check there are no processes running inside the chroot."""
+        self.stop_agent()
         if settings.docker_image:
             (status, output) = run(["docker", "top", self.docker_container])
             count = len(output.strip().split("\n")) - 2 # header + bash launched on container creation
         else:
-            (status, output) = run(["lsof", "-w", "+D", self.name], ignore_errors=True)
-            count = len(output.split("\n")) - 1
+            processes = processes_in_directory(self.name)
+            output = "\n".join("%d %s" % process for process in processes)
+            count = len(processes)
         if count > 0:
             if fail is None:
                 fail = not settings.allow_database
@@ -1725,33 +2609,28 @@ class Chroot:
 
     def terminate_running_processes(self):
         """Terminate all processes running in the chroot."""
+        self.stop_agent()
         if settings.docker_image:
             # Docker takes care of this
             return
-        seen = []
+        signo = SIGTERM
         while True:
-            p = subprocess.Popen(["lsof", "-t", "+D", self.name],
-                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                                 universal_newlines=True)
-            stdout, _ = p.communicate()
-            if not stdout:
-                break
-
-            pidlist = reversed([int(pidstr) for pidstr in stdout.split("\n") if len(pidstr) and int(pidstr) > 0])
-            if not pidlist:
+            pids = [pid for (pid, description) in processes_in_directory(self.name)]
+            if not pids:
                 break
-
-            for pid in pidlist:
+            for pid in reversed(pids):
                 try:
-                    signo = (SIGTERM, SIGKILL)[pid in seen]
                     os.kill(pid, signo)
-                    seen.append(pid)
                     logging.debug("kill -%d %d" % (signo, pid))
-                    time.sleep(0.25)
                 except OSError:
                     pass
-
-            time.sleep(5)
+            # give them up to 5 seconds to exit, then escalate to SIGKILL
+            for i in range(50):
+                time.sleep(0.1)
+                if not processes_in_directory(self.name, pids):
+                    break
+            else:
+                signo = SIGKILL
 
     # If /selinux is present, assume that this is the only supported
     # location by libselinux. Otherwise use the new location.
@@ -1779,6 +2658,7 @@ class Chroot:
 
     def unmount_all(self):
         """Unmount everything we mount()ed into the chroot."""
+        self.stop_agent()
 
         # Workaround to unmount /proc/sys/fs/binfmt_misc which is mounted by
         # update-binfmts but never unmounted
@@ -1817,22 +2697,12 @@ class Chroot:
 
     def is_ignored(self, pathname, info="PATH"):
         """Is a file (or dir or whatever) to be ignored?"""
-        if pathname in settings.ignored_files:
-            return True
-        if ':' + pathname in settings.ignored_files:
+        verbose = get_ignore_matcher().match(pathname)
+        if verbose is None:
+            return False
+        if verbose:
             logging.info("IGNORED %s: %s" % (info, pathname))
-            return True
-        for pattern in settings.ignored_patterns:
-            if pattern[0] == ':':
-                verbose = True
-                pattern = pattern[1:]
-            else:
-                verbose = False
-            if re.search('^' + pattern + '$', pathname):
-                if verbose:
-                    logging.info("IGNORED %s: %s" % (info, pathname))
-                return True
-        return False
+        return True
 
     def check_files_moved_usr(self, packages=[], files_before={}, files_after={}, warn_only=None):
         """Check that no files were moved from /{bin|sbin|lib*} and /usr/{bin|sbin|lib*}"""
@@ -1873,29 +2743,20 @@ class Chroot:
             logging.debug("No file moved between /{bin|sbin|lib*} and /usr/{bin|sbin|lib*}.")
 
 
-    def check_for_broken_symlinks(self, warn_only=None, file_owners={}):
+    def check_for_broken_symlinks(self, warn_only=None, file_owners={}, scan=None):
         """Check that all symlinks in chroot are non-broken."""
         if not settings.check_broken_symlinks:
             return
+        if scan is None:
+            scan = self.scan(clean=False)
         broken = []
-        for dirpath, dirnames, filenames in os.walk(self.name):
-            # Remove /proc within chroot to avoid lots of spurious errors.
-            if dirpath == self.name and "proc" in dirnames:
-                dirnames.remove("proc")
-            for filename in filenames:
-                full_name = name = os.path.join(dirpath, filename)
-                if name.startswith(self.name):
-                    name = name[len(self.name):]
-                ret = is_broken_symlink(self.name, dirpath, filename)
-                if ret and not self.is_ignored(name, info="broken symlink"):
-                    try:
-                        target = os.readlink(full_name)
-                    except os.error:
-                        target = "<unknown>"
-                    entry = "%s -> %s" % (name, target)
-                    if name in file_owners:
-                        entry += " (%s)" % ", ".join(file_owners[name])
-                    broken.append(entry)
+        for name in scan.broken_symlinks:
+            if not self.is_ignored(name, info="broken symlink"):
+                target = scan.tree[name].target
+                entry = "%s -> %s" % (name, target)
+                if name in file_owners:
+                    entry += " (%s)" % ", ".join(file_owners[name])
+                broken.append(entry)
         if broken:
             if settings.warn_broken_symlinks or warn_only:
                 logging.error("WARN: Broken symlinks:\n%s" %
@@ -2026,6 +2887,140 @@ def selinux_enabled(enabled_test="/usr/sbin/selinuxenabled"):
             return False
 
 
+class IgnoreMatcher:
+
+    """Precompiled matcher for settings.ignored_files and
+    settings.ignored_patterns.
+
+    The ignored files are kept in a dict, the patterns are combined into
+    one alternation (for search() as done by diff_meta_data()) and into
+    anchored alternations indexed by the literal first path component of
+    the patterns (for match() as done by Chroot.is_ignored()).  Only if
+    the combined expression matches, the individual patterns are tried to
+    find out whether the first matching one was prefixed with ':'.
+
+    Patterns with global inline flags or references to groups would change
+    their meaning in an alternation, they are tried one by one instead.
+
+    """
+
+    def __init__(self, ignored_files, ignored_patterns):
+        self.key = (tuple(ignored_files), tuple(ignored_patterns))
+        self.files = {}
+        for name in ignored_files:
+            if name[0] == ':':
+                self.files.setdefault(name[1:], True)
+            else:
+                self.files[name] = False
+        self.patterns = []
+        for pattern in ignored_patterns:
+            if pattern[0] == ':':
+                self.patterns.append((True, pattern[1:]))
+            else:
+                self.patterns.append((False, pattern))
+        self.any_verbose = any([verbose for verbose, pattern in self.patterns])
+        self.search_list = [(verbose, re.compile(pattern)) for verbose, pattern in self.patterns]
+        self.match_list = [(verbose, self.anchored(regex)) for verbose, regex in self.search_list]
+        separate = [regex for verbose, regex in self.search_list if not self.combinable(regex)]
+        combined = [regex.pattern for verbose, regex in self.search_list if self.combinable(regex)]
+        try:
+            self.build_combined(combined)
+        except re.error:
+            separate = [regex for verbose, regex in self.search_list]
+            self.build_combined([])
+        self.separate_search = [regex.search for regex in separate]
+        self.separate_match = [self.anchored(regex) for regex in separate]
+
+    def build_combined(self, patterns):
+        self.search_re = self.combine(["(?:%s)" % pattern for pattern in patterns])
+        by_component = {}
+        generic = []
+        for pattern in patterns:
+            component = self.first_component(pattern)
+            if component is None:
+                generic.append(pattern)
+            else:
+                by_component.setdefault(component, []).append(pattern)
+        self.match_generic_re = self.combine(["(?:^%s$)" % pattern for pattern in generic])
+        self.match_re = {}
+        for component, patterns in by_component.items():
+            self.match_re[component] = self.combine(["(?:^%s$)" % pattern for pattern in patterns + generic])
+
+    @staticmethod
+    def combinable(regex):
+        if regex.flags & ~re.UNICODE:
+            return False
+        return not re.search(r"\\[1-9]|\\g<|\(\?P[<=]|\(\?\(", regex.pattern)
+
+    @staticmethod
+    def anchored(regex):
+        """Return a function matching 'regex' against the whole name."""
+        try:
+            return re.compile("^" + regex.pattern + "$").search
+        except re.error:
+            # global inline flags must stay at the start of the expression
+            return regex.fullmatch
+
+    @staticmethod
+    def combine(alternatives):
+        if not alternatives:
+            return None
+        return re.compile("|".join(alternatives))
+
+    @staticmethod
+    def first_component(pattern):
+        """Return the first path component if it is a literal in 'pattern'."""
+        m = re.match(r"/([^/.^$*+?{}\[\]\\|()]+)/(?![?*+{])", pattern)
+        if m and "|" not in pattern:
+            return m.group(1)
+        return None
+
+    def search(self, name):
+        """Return None if 'name' is not ignored, otherwise whether it should
+        be logged (unanchored pattern search)."""
+        if name in self.files:
+            return self.files[name]
+        if (self.search_re is None or not self.search_re.search(name)) and \
+                not any([search(name) for search in self.separate_search]):
+            return None
+        if not self.any_verbose:
+            return False
+        for verbose, pat in self.search_list:
+            if pat.search(name):
+                return verbose
+        return None
+
+    def match(self, name):
+        """Return None if 'name' is not ignored, otherwise whether it should
+        be logged (patterns match the whole name)."""
+        if name in self.files:
+            return self.files[name]
+        component = name.split("/", 2)[1] if name.startswith("/") else None
+        regex = self.match_re.get(component, self.match_generic_re)
+        if (regex is None or not regex.search(name)) and \
+                not any([match(name) for match in self.separate_match]):
+            return None
+        if not self.any_verbose:
+            return False
+        for verbose, match in self.match_list:
+            if match(name):
+                return verbose
+        return None
+
+
+ignore_matcher = None
+
+
+def get_ignore_matcher():
+    """Return the IgnoreMatcher for the current settings, it is only
+    rebuilt if the ignores have been changed."""
+    global ignore_matcher
+    key = (tuple(settings.ignored_files), tuple(settings.ignored_patterns))
+    if ignore_matcher is None or ignore_matcher.key != key:
+        ignore_matcher = IgnoreMatcher(settings.ignored_files, settings.ignored_patterns)
+    return ignore_matcher
+
+
 def objects_are_different(obj1, obj2):
     """Are filesystem objects different based on their meta data?"""
     if (obj1.st.st_mode != obj2.st.st_mode or
@@ -2069,43 +3064,17 @@ def diff_meta_data(tree1, tree2, quiet=False):
     """Compare two dir trees and return list of new files (only in 'tree2'),
        removed files (only in 'tree1'), and modified files."""
 
-    tree1_c = tree1.copy()
-    tree2_c = tree2.copy()
-
-    for name in settings.ignored_files:
-        if name[0] == ':':
-            verbose = not quiet
-            name = name[1:]
-        else:
-            verbose = False
-        if name in tree1_c:
-            if verbose:
-                logging.info("IGNORED PATH@1: %s" % name)
-            del tree1_c[name]
-        if name in tree2_c:
-            if verbose:
-                logging.info("IGNORED PATH@2: %s" % name)
-            del tree2_c[name]
-
-    for pattern in settings.ignored_patterns:
-        if pattern[0] == ':':
-            verbose = not quiet
-            pattern = pattern[1:]
-        else:
-            verbose = False
-        pat = re.compile(pattern)
-        for name in tree1.keys():
-            m = pat.search(name)
-            if m and name in tree1_c:
-                if verbose:
-                    logging.info("IGNORED PATH@1: %s" % name)
-                del tree1_c[name]
-        for name in tree2.keys():
-            m = pat.search(name)
-            if m and name in tree2_c:
-                if verbose:
-                    logging.info("IGNORED PATH@2: %s" % name)
-                del tree2_c[name]
+    # only track the names, the meta data is looked up in tree1/tree2
+    matcher = get_ignore_matcher()
+    tree1_c = {}
+    tree2_c = {}
+    for tree, tree_c, tag in [(tree1, tree1_c, "1"), (tree2, tree2_c, "2")]:
+        for name in tree:
+            verbose = matcher.search(name)
+            if verbose is None:
+                tree_c[name] = None
+            elif verbose and not quiet:
+                logging.info("IGNORED PATH@%s: %s" % (tag, name))
 
     modified = []
     for name in tree1.keys():
@@ -2118,22 +3087,29 @@ def diff_meta_data(tree1, tree2, quiet=False):
             del tree1_c[name]
             del tree2_c[name]
 
-    removed = [x for x in six.iteritems(tree1_c)]
-    new = [x for x in six.iteritems(tree2_c)]
+    removed = [(name, tree1[name]) for name in tree1_c]
+    new = [(name, tree2[name]) for name in tree2_c]
 
     # fix for #586793
     # prune rc?.d symlinks renamed by insserv
-    pat1 = re.compile(r"^(/etc/rc.\.d/)[SK][0-9]{2}(.*)$")
-    for name1, data1 in removed[:]:
-        m = pat1.search(name1)
+    # group them by (directory, script name without S/K number)
+    pat = re.compile(r"^(/etc/rc.\.d/)[SK][0-9]{2}(.*)$")
+    renamed = {}
+    for name2, data2 in new:
+        m = pat.search(name2)
         if m:
-            pat2 = re.compile(r"^" + m.group(1) + r"[SK][0-9]{2}" + m.group(2) + r"$")
-            for name2, data2 in new[:]:
-                m = pat2.search(name2)
-                if m:
-                    logging.debug("File was renamed: %s\t=> %s" % (name1, name2))
-                    removed.remove((name1, data1))
-                    new.remove((name2, data2))
+            renamed.setdefault(m.groups(), []).append(name2)
+    if renamed:
+        pruned = set()
+        for name1, data1 in removed:
+            m = pat.search(name1)
+            if m and renamed.get(m.groups()):
+                name2 = renamed[m.groups()].pop(0)
+                logging.debug("File was renamed: %s\t=> %s" % (name1, name2))
+                pruned.add(name1)
+                pruned.add(name2)
+        removed = [x for x in removed if x[0] not in pruned]
+        new = [x for x in new if x[0] not in pruned]
     # this is again special casing due to the behaviour of a single package :(
     # general tracking of moved files would be the better approach, probably.
 
@@ -2264,9 +3240,12 @@ def process_changes(changes):
     return package_list
 
 
-def check_results(chroot, chroot_state, file_owners, deps_info=None):
+def check_results(chroot, chroot_state, file_owners, deps_info=None, scan=None):
     """Check that current chroot state matches 'chroot_state'.
 
+    If 'scan' is given, it is used as the current state instead of
+    scanning the chroot again.
+
     If settings.warn_on_others is True and deps_info is not None, then only
     print a warning rather than failing if the current chroot contains files
     that are in deps_info but not in chroot_state["tree"].  (In this case, deps_info
@@ -2288,7 +3267,10 @@ def check_results(chroot, chroot_state, file_owners, deps_info=None):
                           indent_string("\n".join(removed)))
             ok = False
 
-    current_info = chroot.get_tree_meta_data()
+    if scan is not None:
+        current_info = scan.tree
+    else:
+        current_info = chroot.get_tree_meta_data()
     if settings.warn_on_others and deps_info is not None:
         (new, removed, modified) = diff_meta_data(reference_info, current_info)
         (depsnew, depsremoved, depsmodified) = diff_meta_data(reference_info,
@@ -2361,7 +3343,8 @@ def install_purge_test(chroot, chroot_state, package_files, packages, extra_pack
 
     chroot.run_scripts("pre_install")
 
-    chroot.install_packages([], extra_packages, with_scripts=False)
+    with PhaseTimer("install-depends"):
+        chroot.install_packages([], extra_packages, with_scripts=False)
 
     if settings.warn_on_others or settings.install_purge_install:
         # Create a metapackage with dependencies from the given packages
@@ -2415,7 +3398,8 @@ def install_purge_test(chroot, chroot_state, package_files, packages, extra_pack
         panic_handler_id = do_on_panic(cleanup_metapackage)
 
         # Install the metapackage
-        chroot.install_package_files([metapackage], with_scripts=False)
+        with PhaseTimer("install-depends"):
+            chroot.install_package_files([metapackage], with_scripts=False)
 
         # Check whether it got installed, the 'dpkg -i p-d-d.deb && apt-get -yf install' approach
         # may not have installed it, cannot happen with 'apt-get install p-d-d.deb' (since stretch)
@@ -2441,7 +3425,8 @@ def install_purge_test(chroot, chroot_state, package_files, packages, extra_pack
     chroot.check_for_no_processes()
     chroot.check_for_broken_symlinks(warn_only=True)  # warn only since no scripts could fix up things after installing the dependencies
 
-    chroot.install_packages(package_files, packages, with_scripts=False)
+    with PhaseTimer("install"):
+        chroot.install_packages(package_files, packages, with_scripts=False)
 
     chroot.run_scripts("post_install")
 
@@ -2451,8 +3436,9 @@ def install_purge_test(chroot, chroot_state, package_files, packages, extra_pack
         logging.info("Validating chroot after purge")
         chroot.check_debsums()
         chroot.check_for_no_processes()
-        chroot.check_for_broken_symlinks(file_owners=file_owners)
-        if not check_results(chroot, chroot_state_with_deps, file_owners, deps_info=deps_info):
+        scan = chroot.scan()
+        chroot.check_for_broken_symlinks(file_owners=file_owners, scan=scan)
+        if not check_results(chroot, chroot_state_with_deps, file_owners, deps_info=deps_info, scan=scan):
             return False
         logging.info("Reinstalling after purge")
         chroot.install_packages(package_files, packages, with_scripts=True)
@@ -2468,17 +3454,19 @@ def install_purge_test(chroot, chroot_state, package_files, packages, extra_pack
     file_owners = chroot.get_files_owned_by_packages()
 
     chroot.check_for_no_processes()
-    chroot.check_for_broken_symlinks(file_owners=file_owners)
+    scan = chroot.scan()
+    chroot.check_for_broken_symlinks(file_owners=file_owners, scan=scan)
 
     # Remove all packages from the chroot that weren't there initially.
-    chroot.restore_selections(chroot_state, packages)
+    chroot.restore_selections(chroot_state, packages, scan=scan)
 
     chroot.run_scripts("post_test")
 
     chroot.check_for_no_processes(fail=True)
-    chroot.check_for_broken_symlinks(file_owners=file_owners)
+    scan = chroot.scan()
+    chroot.check_for_broken_symlinks(file_owners=file_owners, scan=scan)
 
-    return check_results(chroot, chroot_state, file_owners, deps_info=deps_info)
+    return check_results(chroot, chroot_state, file_owners, deps_info=deps_info, scan=scan)
 
 
 def install_upgrade_test(chroot, chroot_state, package_files, packages, old_packages):
@@ -2491,7 +3479,8 @@ def install_upgrade_test(chroot, chroot_state, package_files, packages, old_pack
     # First install via apt-get.
     os.environ["PIUPARTS_PHASE"] = "install"
 
-    chroot.install_packages_by_name(old_packages)
+    with PhaseTimer("install"):
+        chroot.install_packages_by_name(old_packages)
 
     chroot.check_for_no_processes()
     chroot.check_for_broken_symlinks()
@@ -2507,45 +3496,388 @@ def install_upgrade_test(chroot, chroot_state, package_files, packages, old_pack
 
     chroot.enable_testdebs_repo()
 
-    chroot.install_packages(package_files, packages)
+    with PhaseTimer("upgrade"):
+        chroot.install_packages(package_files, packages)
 
     chroot.disable_testdebs_repo()
 
     file_owners_after = chroot.get_files_owned_by_packages()
 
     chroot.check_for_no_processes()
-    chroot.check_for_broken_symlinks(file_owners=file_owners_after)
+    scan = chroot.scan()
+    chroot.check_for_broken_symlinks(file_owners=file_owners_after, scan=scan)
     if settings.warn_on_usr_move != "disabled":
         chroot.check_files_moved_usr(packages, file_owners_before, file_owners_after)
 
     # Remove all packages from the chroot that weren't there initially.
-    chroot.restore_selections(chroot_state, packages)
+    chroot.restore_selections(chroot_state, packages, scan=scan)
 
     chroot.run_scripts("post_test")
 
     chroot.check_for_no_processes(fail=True)
-    chroot.check_for_broken_symlinks(file_owners=file_owners_after)
-
-    return check_results(chroot, chroot_state, file_owners_after)
+    scan = chroot.scan()
+    chroot.check_for_broken_symlinks(file_owners=file_owners_after, scan=scan)
+
+    return check_results(chroot, chroot_state, file_owners_after, scan=scan)
+
+
+META_DATA_MAGIC = b"PIUPARTS-META"
+META_DATA_VERSION = 1
+
+
+def little_endian(column):
+    """Return the bytes of an array in little endian byte order."""
+    if sys.byteorder == "big":
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def array_from_little_endian(typecode, data):
+    column = array.array(typecode)
+    column.frombytes(data)
+    if sys.byteorder == "big":
+        column.byteswap()
+    return column
+
+
+def encode_tree_meta_data(tree):
+    """Encode a TreeMetaData in columns: the sorted path names (each
+    stored as the length of the prefix shared with the previous name plus
+    the remaining suffix), the mode, uid, gid and size arrays and the
+    symlink targets with their positions."""
+    names = sorted(tree.index)
+    order = [tree.index[name] for name in names]
+    prefixes = array.array('I')
+    suffixes = []
+    target_positions = array.array('I')
+    targets = []
+    previous = ""
+    for pos, name in enumerate(names):
+        common = len(os.path.commonprefix([previous, name]))
+        prefixes.append(common)
+        suffixes.append(name[common:])
+        previous = name
+        target = tree.targets.get(order[pos])
+        if target is not None:
+            target_positions.append(pos)
+            targets.append(target)
+    columns = [
+        little_endian(prefixes),
+        "\0".join(suffixes).encode("utf-8", "surrogateescape"),
+        little_endian(array.array('I', (tree.mode[i] for i in order))),
+        little_endian(array.array('I', (tree.uid[i] for i in order))),
+        little_endian(array.array('I', (tree.gid[i] for i in order))),
+        little_endian(array.array('Q', (tree.size[i] for i in order))),
+        little_endian(target_positions),
+        "\0".join(targets).encode("utf-8", "surrogateescape"),
+    ]
+    return struct.pack("<I", len(names)) + \
+        b"".join(struct.pack("<Q", len(column)) + column for column in columns)
+
+
+def decode_tree_meta_data(data, uidmap, gidmap):
+    """Decode the output of encode_tree_meta_data() into a TreeMetaData."""
+    (count,) = struct.unpack_from("<I", data)
+    offset = 4
+    columns = []
+    for i in range(8):
+        (length,) = struct.unpack_from("<Q", data, offset)
+        offset += 8
+        columns.append(data[offset:offset + length])
+        offset += length
+    prefixes = array_from_little_endian('I', columns[0])
+    suffixes = columns[1].decode("utf-8", "surrogateescape").split("\0") if count else []
+    tree = TreeMetaData(uidmap, gidmap)
+    previous = ""
+    for pos in range(count):
+        previous = previous[:prefixes[pos]] + suffixes[pos]
+        tree.index[sys.intern(previous)] = pos
+    tree.mode = array_from_little_endian('I', columns[2])
+    tree.uid = array_from_little_endian('I', columns[3])
+    tree.gid = array_from_little_endian('I', columns[4])
+    tree.size = array_from_little_endian('Q', columns[5])
+    target_positions = array_from_little_endian('I', columns[6])
+    if target_positions:
+        targets = columns[7].decode("utf-8", "surrogateescape").split("\0")
+        tree.targets = dict(zip(target_positions, targets))
+    return tree
+
+
+class LazyChrootState(dict):
+
+    """A chroot state loaded by load_meta_data().  The file meta data is
+    only decompressed and decoded when chroot_state["tree"] is used."""
+
+    def __init__(self, state, tree_data, uidmap, gidmap):
+        dict.__init__(self, state)
+        self.tree_data = tree_data
+        self.uidmap = uidmap
+        self.gidmap = gidmap
+
+    def __missing__(self, key):
+        if key != "tree" or self.tree_data is None:
+            raise KeyError(key)
+        tree = decode_tree_meta_data(zlib.decompress(self.tree_data), self.uidmap, self.gidmap)
+        self.tree_data = None
+        self["tree"] = tree
+        return tree
 
 
 def save_meta_data(filename, chroot_state):
-    """Save directory tree meta data into a file for fast access later."""
+    """Save directory tree meta data into a file for fast access later.
+
+    The file starts with a "PIUPARTS-META <version>" line, followed by
+    the length of the compressed JSON encoded package state and the state
+    itself, and the compressed columnar encoding of the file meta data."""
     logging.debug("Saving chroot meta data to %s" % filename)
+    tree = chroot_state["tree"]
+    if not isinstance(tree, TreeMetaData):
+        converted = TreeMetaData()
+        for name, info in tree.items():
+            converted.add(name, info.st.st_mode, info.st.st_uid, info.st.st_gid, info.st.st_size, info.target)
+            converted.uidmap[info.st.st_uid] = info.user
+            converted.gidmap[info.st.st_gid] = info.group
+        tree = converted
+    state = dict((key, value) for (key, value) in chroot_state.items() if key != "tree")
+    state["uidmap"] = sorted(tree.uidmap.items())
+    state["gidmap"] = sorted(tree.gidmap.items())
+    header = zlib.compress(json.dumps(state, sort_keys=True).encode())
     with open(filename, "wb") as f:
-        pickle.dump(chroot_state, f)
+        f.write(META_DATA_MAGIC + b" %d\n" % META_DATA_VERSION)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        f.write(zlib.compress(encode_tree_meta_data(tree)))
 
 
 def load_meta_data(filename):
-    """Load meta data saved by 'save_meta_data'."""
+    """Load meta data saved by 'save_meta_data'.
+
+    Returns None if the file was written in an unsupported format version.
+    Files in the older pickle format are converted in place."""
     logging.debug("Loading chroot meta data from %s" % filename)
     with open(filename, "rb") as f:
-        return pickle.load(f)
+        data = f.read()
+    if not data.startswith(META_DATA_MAGIC + b" "):
+        return convert_meta_data(filename, pickle.loads(data))
+    (line, data) = data.split(b"\n", 1)
+    version = int(line.split()[1])
+    if version != META_DATA_VERSION:
+        logging.info("Unsupported meta data format version %d in %s" % (version, filename))
+        return None
+    (length,) = struct.unpack_from("<Q", data)
+    state = json.loads(zlib.decompress(data[8:8 + length]))
+    uidmap = dict(state.pop("uidmap"))
+    gidmap = dict(state.pop("gidmap"))
+    for key in ("initial_selections", "selections"):
+        if state.get(key) is not None:
+            state[key] = dict((name, tuple(value)) for (name, value) in state[key].items())
+    return LazyChrootState(state, data[8 + length:], uidmap, gidmap)
+
+
+def convert_meta_data(filename, chroot_state):
+    """Rewrite a chroot state loaded from a pickle in the current format."""
+    if not isinstance(chroot_state, dict) or "tree" not in chroot_state:
+        return chroot_state
+    logging.info("Converting chroot meta data in %s to format version %d" % (filename, META_DATA_VERSION))
+    try:
+        save_meta_data(filename + ".new", chroot_state)
+        os.rename(filename + ".new", filename)
+    except (IOError, OSError) as detail:
+        logging.info("Cannot convert %s: %s" % (filename, detail))
+    return chroot_state
+
+
+def initial_selections_differ(chroot, chroot_state):
+    """Return True (and log the differences) if the initial package
+    selections of 'chroot' do not match those of a loaded reference chroot
+    state."""
+    if chroot.initial_selections == chroot_state["initial_selections"]:
+        return False
+    logging.warn("Initial package selections do not match - ignoring loaded reference chroot state")
+    refsel = [(s, p, v) for p, (s, v) in six.iteritems(chroot_state["initial_selections"] or {})]
+    cursel = [(s, p, v) for p, (s, v) in six.iteritems(chroot.initial_selections or {})]
+    rsel = [x for x in refsel if not x in cursel]
+    csel = [x for x in cursel if not x in refsel]
+    [logging.debug("  -%s" % " ".join(x)) for x in rsel]
+    [logging.debug("  +%s" % " ".join(x)) for x in csel]
+    return True
+
+
+file_identities = {}
+
+
+def file_identity(filename):
+    """Return (size, mtime, sha256) of a file.  The checksum is only
+    calculated once per run, unless the size or mtime changes."""
+    st = os.stat(filename)
+    key = (os.path.abspath(filename), st.st_ino, st.st_size, st.st_mtime)
+    if key not in file_identities:
+        sha256 = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha256.update(chunk)
+        file_identities[key] = sha256.hexdigest()
+    return (st.st_size, st.st_mtime, file_identities[key])
+
+
+def reference_meta_cache_key():
+    """Return everything the reference chroot state depends on, apart from
+    the package selections and the available packages.  The key is stored
+    as JSON, so it only consists of dicts, lists and plain values."""
+    scripts = []
+    for sdir in settings.scriptsdirs:
+        for sfile in sorted(os.listdir(sdir)):
+            st = os.stat(os.path.join(sdir, sfile))
+            scripts.append((sdir, sfile, st.st_size, st.st_mtime))
+    key = {
+        "basetgz": file_identity(settings.basetgz),
+        "distros": settings.debian_distros,
+        "mirrors": settings.debian_mirrors,
+        "extra_repos": settings.extra_repos,
+        "keep_sources_list": settings.keep_sources_list,
+        "arch": settings.arch,
+        "proxy": settings.proxy,
+        "install_recommends": settings.install_recommends,
+        "install_suggests": settings.install_suggests,
+        "eatmydata": settings.eatmydata,
+        "dpkg_force_unsafe_io": settings.dpkg_force_unsafe_io,
+        "dpkg_force_confdef": settings.dpkg_force_confdef,
+        "do_not_verify_signatures": settings.do_not_verify_signatures,
+        "no_check_valid_until": settings.no_check_valid_until,
+        "allow_database": settings.allow_database,
+        "bindmounts": settings.bindmounts,
+        "minimize": settings.minimize,
+        "fake_essential_packages": settings.fake_essential_packages,
+        "scripts": scripts,
+    }
+    return json.loads(json.dumps(key))
+
+
+def load_cached_chroot_state(cache_file, chroot):
+    """Return the chroot state cached in 'cache_file' if it was created with
+    the current settings and the same history of available packages as
+    'chroot', None otherwise."""
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        cached = load_meta_data(cache_file)
+    except Exception as detail:
+        logging.info("Cannot load cached reference chroot state from %s: %s" % (cache_file, detail))
+        return None
+    if cached is None or cached.get("reference_key") != reference_meta_cache_key() or \
+            cached["avail_md5"] != chroot.avail_md5_history:
+        return None
+    if initial_selections_differ(chroot, cached):
+        return None
+    del cached["reference_key"]
+    return cached
+
+
+def save_cached_chroot_state(cache_file, chroot_state):
+    """Atomically replace 'cache_file' with 'chroot_state' and the key of the
+    current settings."""
+    tmpfile = cache_file + ".new"
+    try:
+        (fd, tmpfile) = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(cache_file)))
+        os.close(fd)
+        save_meta_data(tmpfile, dict(chroot_state, reference_key=reference_meta_cache_key()))
+        os.chmod(tmpfile, 0o644)
+        os.rename(tmpfile, cache_file)
+    except (IOError, OSError) as detail:
+        logging.info("Cannot cache reference chroot state in %s: %s" % (cache_file, detail))
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
 
 
-def install_and_upgrade_between_distros(package_files, packages_qualified):
+def get_reference_chroot_state(chroot):
+    """Return the state of the freshly created 'chroot'.
+
+    With --reference-meta-cache the state is cached next to the base
+    tarball and reused as long as the tarball, the relevant settings, the
+    package selections and the available packages did not change.
+    """
+    if not settings.reference_meta_cache or not settings.basetgz:
+        return chroot.get_state_meta_data()
+
+    cache_file = settings.basetgz + ".piuparts-meta"
+    cached = load_cached_chroot_state(cache_file, chroot)
+    if cached is not None and cached["selections"] == chroot.get_selections():
+        logging.info("Using cached reference chroot state from %s" % cache_file)
+        return cached
+    if os.path.exists(cache_file):
+        logging.info("Cached reference chroot state in %s is outdated" % cache_file)
+
+    chroot_state = chroot.get_state_meta_data()
+    save_cached_chroot_state(cache_file, chroot_state)
+    return chroot_state
+
+
+def load_upgraded_reference_chroot_state(chroot):
+    """Return the cached state of a reference chroot upgraded to the target
+    distro, or None.
+
+    The state is cached in 'TARBALL.piuparts-end-meta' next to the base
+    tarball, keyed by the history of available packages. 'chroot' must
+    already be upgraded to the target distro to look up the cache.
+    """
+    cache_file = settings.basetgz + ".piuparts-end-meta"
+    chroot_state = load_cached_chroot_state(cache_file, chroot)
+    if chroot_state is not None:
+        logging.info("Using cached upgraded reference chroot state from %s" % cache_file)
+        return chroot_state
+    if os.path.exists(cache_file):
+        logging.info("Cached upgraded reference chroot state in %s is outdated" % cache_file)
+    return None
+
+
+def have_upgraded_reference_chroot_state():
+    """Return True if there is a cached upgraded reference chroot state for
+    the current base tarball and settings. Whether it matches the available
+    packages can only be checked after the upgrade."""
+    cache_file = settings.basetgz + ".piuparts-end-meta"
+    if not os.path.exists(cache_file):
+        return False
+    try:
+        cached = load_meta_data(cache_file)
+    except Exception:
+        return False
+    return cached is not None and cached.get("reference_key") == reference_meta_cache_key()
+
+
+def create_upgraded_reference_chroot_state():
+    """Upgrade a fresh chroot to the target distro, cache its state next to
+    the base tarball and return it. This must not be done while a test
+    chroot is set up, to not need the space for two chroots."""
+    # the reference chroot is upgraded outside of any test phase
+    phase = os.environ.pop("PIUPARTS_PHASE", None)
+    reference = get_chroot()
+    reference.create()
+    reference.remember_initial_selections()
+    with PhaseTimer("reference-distupgrade"):
+        reference.upgrade_to_distros(settings.debian_distros[1:], [])
+    reference.check_for_no_processes(fail=True)
+    chroot_state = reference.get_state_meta_data()
+    reference.remove()
+    if phase is not None:
+        os.environ["PIUPARTS_PHASE"] = phase
+
+    save_cached_chroot_state(settings.basetgz + ".piuparts-end-meta", chroot_state)
+    return chroot_state
+
+
+def save_end_meta_data(chroot_state):
+    """Save the reference chroot state for --save-end-meta."""
+    save_meta_data(settings.save_end_meta, chroot_state)
+    logging.info("Saved reference chroot state to %s (available packages history: %s)"
+                 % (settings.save_end_meta, " ".join(chroot_state["avail_md5"])))
+
+
+def install_and_upgrade_between_distros(package_files, packages_qualified, upgraded_reference=None):
     """Install package and upgrade it between distributions, then remove.
-       Return True if successful, False if not."""
+       Return True if successful, False if not.
+       'upgraded_reference' is the state of an upgraded reference chroot
+       that has just been created, it is used if the cache lookup fails."""
 
     # this function is a bit confusing at first, because of what it does by default:
     # 1. create chroot with source distro
@@ -2572,8 +3904,16 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
 
     packages = unqualify(packages_qualified)
 
-    chroot = get_chroot()
-    chroot.create()
+    # With --reference-meta-cache a missing upgraded reference chroot state
+    # is created before the test chroot, see below.
+    if upgraded_reference is None and settings.reference_meta_cache and settings.basetgz and \
+            not settings.distupgrade_to_testdebs and \
+            not (settings.end_meta and os.path.exists(settings.end_meta)) and \
+            not have_upgraded_reference_chroot_state():
+        upgraded_reference = create_upgraded_reference_chroot_state()
+
+    chroot = create_chroot(packages_qualified, package_files)
+    use_tmpfs = chroot.tmpfs
     chroot.remember_initial_selections()
 
     chroot_state = None
@@ -2583,32 +3923,31 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
         else:
             logging.info("Cannot load chroot state from %s - generating it on-the-fly." % settings.end_meta)
 
-    if chroot_state is not None:
-        if chroot.initial_selections != chroot_state["initial_selections"]:
-            logging.warn("Initial package selections do not match - ignoring loaded reference chroot state")
-            refsel = [(s, p, v) for p, (s, v) in six.iteritems(chroot_state["initial_selections"])]
-            cursel = [(s, p, v) for p, (s, v) in six.iteritems(chroot.initial_selections)]
-            rsel = [x for x in refsel if not x in cursel]
-            csel = [x for x in cursel if not x in refsel]
-            [logging.debug("  -%s" % " ".join(x)) for x in rsel]
-            [logging.debug("  +%s" % " ".join(x)) for x in csel]
-            chroot_state = None
-
-    if chroot_state is None:
+    if chroot_state is not None and initial_selections_differ(chroot, chroot_state):
+        chroot_state = None
+
+    # With --reference-meta-cache the upgraded reference chroot state is
+    # looked up by the history of available packages after the package
+    # has been upgraded, see load_upgraded_reference_chroot_state().
+    upgraded_reference_cache = chroot_state is None and settings.reference_meta_cache and \
+        settings.basetgz and not settings.distupgrade_to_testdebs
+
+    if chroot_state is None and not upgraded_reference_cache:
         temp_tgz = None
         if chroot.was_bootstrapped():
             temp_tgz = chroot.create_temp_tgz_file()
             panic_handler_id = do_on_panic(lambda: chroot.remove_temp_tgz_file(temp_tgz))
             chroot.pack_into_tgz(temp_tgz)
 
-        chroot.upgrade_to_distros(settings.debian_distros[1:], [])
+        with PhaseTimer("reference-distupgrade"):
+            chroot.upgrade_to_distros(settings.debian_distros[1:], [])
 
         chroot.check_for_no_processes(fail=True)
 
         chroot_state = chroot.get_state_meta_data()
 
         if settings.save_end_meta:
-            save_meta_data(settings.save_end_meta, chroot_state)
+            save_end_meta_data(chroot_state)
 
         chroot.remove()
 
@@ -2617,6 +3956,7 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
             "Notice: package selections and meta data from target distro saved, now starting over from source distro. See the description of --save-end-meta and --end-meta to learn why this is neccessary and how to possibly avoid it.")
 
         chroot = get_chroot()
+        chroot.use_tmpfs = use_tmpfs
         if temp_tgz is None:
             chroot.create()
         else:
@@ -2647,7 +3987,8 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
 
     distupgrade_packages = packages
     known_packages = chroot.get_known_packages(packages + settings.extra_old_packages)
-    chroot.install_packages_by_name(known_packages)
+    with PhaseTimer("install"):
+        chroot.install_packages_by_name(known_packages)
 
     if settings.install_remove_install:
         chroot.remove_packages(packages, ignore_errors=True)
@@ -2660,12 +4001,13 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
 
     os.environ["PIUPARTS_PHASE"] = "distupgrade"
 
-    chroot.upgrade_to_distros(settings.debian_distros[1:-1], distupgrade_packages, settings.upgrade_before_dist_upgrade)
+    with PhaseTimer("distupgrade"):
+        chroot.upgrade_to_distros(settings.debian_distros[1:-1], distupgrade_packages, settings.upgrade_before_dist_upgrade)
 
-    if settings.distupgrade_to_testdebs:
-        chroot.enable_testdebs_repo(update=False)
+        if settings.distupgrade_to_testdebs:
+            chroot.enable_testdebs_repo(update=False)
 
-    chroot.upgrade_to_distros(settings.debian_distros[-1:], distupgrade_packages, settings.upgrade_before_dist_upgrade)
+        chroot.upgrade_to_distros(settings.debian_distros[-1:], distupgrade_packages, settings.upgrade_before_dist_upgrade)
 
     chroot.check_for_no_processes()
 
@@ -2674,7 +4016,8 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
     if not settings.distupgrade_to_testdebs:
         chroot.enable_testdebs_repo()
 
-    chroot.install_packages(package_files, [p for p in packages_qualified if not p.endswith("=None")])
+    with PhaseTimer("upgrade"):
+        chroot.install_packages(package_files, [p for p in packages_qualified if not p.endswith("=None")])
 
     chroot.disable_testdebs_repo()
 
@@ -2686,6 +4029,24 @@ def install_and_upgrade_between_distros(package_files, packages_qualified):
         file_owners_after = chroot.get_files_owned_by_packages()
         chroot.check_files_moved_usr(packages, files_before=file_owners_before, files_after=file_owners_after)
 
+    if upgraded_reference_cache:
+        chroot_state = load_upgraded_reference_chroot_state(chroot)
+        if chroot_state is None and upgraded_reference is None:
+            # The available packages changed since the cached state was
+            # created. Don't set up a reference chroot next to the test
+            # chroot, but start over once the reference is done.
+            if settings.shell_on_error:
+                dont_do_on_panic(panic_handler_id)
+            chroot.remove()
+            upgraded_reference = create_upgraded_reference_chroot_state()
+            logging.info("Notice: upgraded reference chroot state saved, now starting over from source distro.")
+            return install_and_upgrade_between_distros(package_files, packages_qualified, upgraded_reference)
+        if chroot_state is None:
+            logging.info("Available packages changed again, using the reference chroot state created before the test.")
+            chroot_state = upgraded_reference
+        if settings.save_end_meta:
+            save_end_meta_data(chroot_state)
+
     # Remove all packages from the chroot that weren't in the reference chroot.
     chroot.restore_selections(chroot_state, packages_qualified)
 
@@ -2757,6 +4118,10 @@ def parse_command_line():
                            "chroot, instead of building a new one with " +
                            "debootstrap.")
 
+    parser.add_option("--batch", default=False, action="store_true",
+                      help="Test all packages from the command line individually " +
+                           "in copy-on-write overlays of a single base chroot.")
+
     parser.add_option("--bindmount", action="append", metavar="DIR",
                       default=[],
                       help="Directory to be bind-mounted inside the chroot.")
@@ -2840,6 +4205,9 @@ def parse_command_line():
                       action="store_true", default=False,
                       help="Enable the installation of Suggests.")
 
+    parser.add_option("-j", "--jobs", metavar="N", type="int", default=1,
+                      help="Run up to N tests in parallel.")
+
     def keep_env_parser(option, opt_str, value, parser):
         setattr(parser.values, option.dest, True)
         if "--keep-tmpdir" == opt_str:
@@ -2887,6 +4255,31 @@ def parse_command_line():
                       "DOCKER-IMAGE for the testing environment, instead of "
                       "building a new one with debootstrap.")
 
+    parser.add_option("--tmpfs-chroot", metavar="SIZE", action="store",
+                      help="Create the chroot on a tmpfs of SIZE (e.g. 4G) mounted by piuparts, " +
+                      "unless the packages to be tested (and their dependencies) are too large for it.")
+
+    parser.add_option("--tmpfs-max-installed-size", metavar="SIZE", type="int",
+                      help="Fall back to a chroot on disk if the Installed-Size of the packages to be " +
+                      "tested and their dependencies exceeds SIZE (in MB). " +
+                      "Default: half of the free space on the tmpfs.")
+
+    parser.add_option("--apt-archive-cache", metavar="DIR",
+                      help="Share the packages downloaded by apt between piuparts runs " +
+                      "through a cache in DIR.")
+
+    parser.add_option("--apt-archive-cache-size", metavar="SIZE", type="int",
+                      help="Remove the least recently used packages from the apt archive cache " +
+                      "if it grows larger than SIZE (in MB).")
+
+    parser.add_option("--apt-lists-cache", metavar="DIR",
+                      help="Share the package index files between piuparts runs through a " +
+                      "cache in DIR instead of running 'apt-get update' for every chroot.")
+
+    parser.add_option("--apt-lists-cache-max-age", metavar="MINUTES", type="int", default=60,
+                      help="Run 'apt-get update' again if the cached package index files " +
+                      "are older than MINUTES. Default: 60.")
+
     parser.add_option("--merged-usr",
                       default=False,
                       action='store_true',
@@ -2980,6 +4373,12 @@ def parse_command_line():
     parser.add_option("-S", "--save-end-meta", metavar="FILE",
                       help="Save chroot package selection and file meta data in FILE for later use. See the function install_and_upgrade_between_distros() in piuparts.py for defaults. Mostly useful for large scale distro upgrade tests.")
 
+    parser.add_option("--reference-meta-cache", default=False,
+                      action="store_true",
+                      help="Cache the reference chroot state (or the state of the upgraded reference " +
+                      "chroot in distupgrade tests) next to the --basetgz tarball " +
+                      "and reuse it while the tarball and the available packages are unchanged.")
+
     parser.add_option("--single-changes-list", default=False,
                       action="store_true",
                       help="test all packages from all changes files together.")
@@ -3021,6 +4420,14 @@ def parse_command_line():
                            "times. Useful to work around temporary network failures "
                            "and hashsum mismatch errors.")
 
+    parser.add_option("--tree-scan-threads", metavar="N", type="int", default=0,
+                      help="Scan the top level directories of the chroot in N parallel " +
+                      "threads when recording the filesystem meta data.")
+
+    parser.add_option("--chroot-agent", action="store_true", default=False,
+                      help="Run the commands in the chroot through a single long-lived " +
+                      "shell instead of starting a new chroot for every command.")
+
     parser.add_option("-v", "--verbose",
                       action="store_true", default=False,
                       help="No meaning anymore.")
@@ -3072,6 +4479,10 @@ def parse_command_line():
                       default=0,
                       help="Set maximum permitted command output to SIZE (in MB).")
 
+    parser.add_option("--max-command-runtime", action="store", metavar='SECONDS',
+                      default=0, type="int",
+                      help="Terminate commands running in the chroot after SECONDS seconds. The default is 3600.")
+
     (opts, args) = parser.parse_args()
 
     # expand combined options
@@ -3088,8 +4499,12 @@ def parse_command_line():
     settings.shell_on_error = opts.shell_on_error
     if opts.max_command_output_size:
         settings.max_command_output_size = int(opts.max_command_output_size) * 1024 * 1024;
+    if opts.max_command_runtime:
+        settings.max_command_runtime = opts.max_command_runtime
     settings.single_changes_list = opts.single_changes_list
     settings.single_packages = opts.single_packages
+    settings.batch = opts.batch
+    settings.jobs = opts.jobs
     settings.args_are_package_files = not opts.apt
     # distro setup
     settings.proxy = opts.proxy
@@ -3126,11 +4541,20 @@ def parse_command_line():
     settings.savetgz = opts.save
     settings.lvm_volume = opts.lvm_volume
     settings.lvm_snapshot_size = opts.lvm_snapshot_size
+    settings.tmpfs_size = opts.tmpfs_chroot
+    settings.tmpfs_max_installed_size = opts.tmpfs_max_installed_size
+    if opts.apt_archive_cache:
+        settings.apt_archive_cache = os.path.abspath(opts.apt_archive_cache)
+    settings.apt_archive_cache_size = opts.apt_archive_cache_size
+    if opts.apt_lists_cache:
+        settings.apt_lists_cache = os.path.abspath(opts.apt_lists_cache)
+    settings.apt_lists_cache_max_age = opts.apt_lists_cache_max_age
     settings.existing_chroot = opts.existing_chroot
     settings.hard_link = opts.hard_link
     settings.schroot = opts.schroot
     settings.end_meta = opts.end_meta
     settings.save_end_meta = opts.save_end_meta
+    settings.reference_meta_cache = opts.reference_meta_cache
     settings.skip_minimize = opts.skip_minimize
     settings.minimize = opts.minimize
     if settings.minimize:
@@ -3138,6 +4562,8 @@ def parse_command_line():
     settings.debfoster_options = opts.debfoster_options.split()
     settings.docker_image = opts.docker_image
     settings.merged_usr = opts.merged_usr
+    settings.tree_scan_threads = opts.tree_scan_threads
+    settings.chroot_agent = opts.chroot_agent
     # tests and checks
     settings.no_install_purge_test = opts.no_install_purge_test
     settings.no_upgrade_test = opts.no_upgrade_test
@@ -3218,6 +4644,18 @@ def parse_command_line():
                       "with only one distribution")
         exitcode = 1
 
+    if settings.jobs < 1:
+        logging.error("--jobs must be at least 1")
+        exitcode = 1
+
+    if settings.jobs > 1 and settings.shell_on_error:
+        logging.error("--shell-on-error cannot be used together with --jobs")
+        exitcode = 1
+
+    if settings.batch and (settings.schroot or settings.docker_image):
+        logging.error("--batch cannot be used together with --schroot or --docker-image")
+        exitcode = 1
+
     if not args:
         logging.error("Need command line arguments: " +
                       "names of packages or package files")
@@ -3233,62 +4671,78 @@ def parse_command_line():
 def get_chroot():
     return Chroot()
 
-# Process the packages given in a list
-def process_packages(package_list):
-    # Find the names of packages.
-    if settings.args_are_package_files:
-        packages = get_package_names_from_package_files(package_list)
-        package_files = package_list
-    else:
-        packages = package_list
-        package_files = []
 
-    if len(settings.debian_distros) == 1:
+def create_chroot(packages, package_files):
+    """Create a chroot, preferably on a tmpfs (if enabled). Fall back to a
+    chroot on disk if the packages to be tested are too large for it."""
+    chroot = get_chroot()
+    if not chroot.create(packages=packages, package_files=package_files):
+        logging.info("Packages are too large for the tmpfs, recreating the chroot on disk.")
+        chroot.remove()
         chroot = get_chroot()
+        chroot.use_tmpfs = False
         chroot.create()
+    return chroot
 
-        if settings.shell_on_error:
-            panic_handler_id = do_on_panic(lambda: chroot.interactive_shell())
+def get_package_names(package_list):
+    """Return the names of the packages in 'package_list' and the package
+    files to be installed."""
+    if settings.args_are_package_files:
+        return get_package_names_from_package_files(package_list), package_list
+    return package_list, []
 
-        chroot_state = chroot.get_state_meta_data()
 
-        testable = True
-        cannot_test = chroot.run_scripts("is_testable", ignore_errors=True)
-        if cannot_test != 0:
-            testable = False
-            if cannot_test & 2:
-                logging.info("FAIL: All tests. Package cannot be tested with piuparts: %s.", " ".join(packages))
-                panic()
-            else:
-                logging.info("SKIP: All tests. Package cannot be tested with piuparts: %s.", " ".join(packages))
+def test_packages(chroot, chroot_state, package_files, packages):
+    """Run the install-purge and install-upgrade-purge tests in 'chroot'."""
+    if settings.shell_on_error:
+        panic_handler_id = do_on_panic(lambda: chroot.interactive_shell())
 
-        if testable and not settings.no_install_purge_test:
-            extra_packages = chroot.get_known_packages(settings.extra_old_packages)
-            if not install_purge_test(chroot, chroot_state,
-                                      package_files, packages, extra_packages):
-                logging.error("FAIL: Installation and purging test.")
-                panic()
-            logging.info("PASS: Installation and purging test.")
+    testable = True
+    cannot_test = chroot.run_scripts("is_testable", ignore_errors=True)
+    if cannot_test != 0:
+        testable = False
+        if cannot_test & 2:
+            logging.info("FAIL: All tests. Package cannot be tested with piuparts: %s.", " ".join(packages))
+            panic()
+        else:
+            logging.info("SKIP: All tests. Package cannot be tested with piuparts: %s.", " ".join(packages))
+
+    if testable and not settings.no_install_purge_test:
+        extra_packages = chroot.get_known_packages(settings.extra_old_packages)
+        if not install_purge_test(chroot, chroot_state,
+                                  package_files, packages, extra_packages):
+            logging.error("FAIL: Installation and purging test.")
+            panic()
+        logging.info("PASS: Installation and purging test.")
 
-        if testable and not settings.no_upgrade_test:
-            if not settings.args_are_package_files and not settings.testdebs_repo:
-                logging.info("Can't test upgrades: -a or --apt option used.")
+    if testable and not settings.no_upgrade_test:
+        if not settings.args_are_package_files and not settings.testdebs_repo:
+            logging.info("Can't test upgrades: -a or --apt option used.")
+        else:
+            packages_to_query = unqualify(packages)
+            packages_to_query.extend(settings.extra_old_packages)
+            known_packages = chroot.get_known_packages(packages_to_query)
+            if not known_packages:
+                logging.info("Can't test upgrade: packages not known by apt-get.")
+            elif install_upgrade_test(chroot, chroot_state, package_files,
+                                      packages, known_packages):
+                logging.info("PASS: Installation, upgrade and purging tests.")
             else:
-                packages_to_query = unqualify(packages)
-                packages_to_query.extend(settings.extra_old_packages)
-                known_packages = chroot.get_known_packages(packages_to_query)
-                if not known_packages:
-                    logging.info("Can't test upgrade: packages not known by apt-get.")
-                elif install_upgrade_test(chroot, chroot_state, package_files,
-                                          packages, known_packages):
-                    logging.info("PASS: Installation, upgrade and purging tests.")
-                else:
-                    logging.error("FAIL: Installation, upgrade and purging tests.")
-                    panic()
+                logging.error("FAIL: Installation, upgrade and purging tests.")
+                panic()
 
-        if settings.shell_on_error:
-            dont_do_on_panic(panic_handler_id)
+    if settings.shell_on_error:
+        dont_do_on_panic(panic_handler_id)
+
+
+# Process the packages given in a list
+def process_packages(package_list):
+    packages, package_files = get_package_names(package_list)
 
+    if len(settings.debian_distros) == 1:
+        chroot = create_chroot(packages, package_files)
+        chroot_state = get_reference_chroot_state(chroot)
+        test_packages(chroot, chroot_state, package_files, packages)
         chroot.remove()
     else:
         if install_and_upgrade_between_distros(package_files, packages):
@@ -3298,6 +4752,122 @@ def process_packages(package_list):
             panic()
 
 
+def process_packages_in_batch(package_lists):
+    """Test each list of packages separately in a copy-on-write overlay of a
+    single base chroot, which is only set up once."""
+    if len(settings.debian_distros) > 1:
+        # each distupgrade test needs its own upgraded chroot
+        for package_list in package_lists:
+            process_packages(package_list)
+        return
+
+    base = get_chroot()
+    base.create()
+    chroot_state = get_reference_chroot_state(base)
+    base.freeze()
+
+    for i, package_list in enumerate(package_lists, 1):
+        packages, package_files = get_package_names(package_list)
+        logging.info("-" * 78)
+        logging.info("Testing %s (%d/%d)" % (" ".join(packages), i, len(package_lists)))
+        chroot = get_chroot()
+        chroot.create_overlay(base)
+        test_packages(chroot, chroot_state, package_files, packages)
+        chroot.remove()
+
+    base.remove()
+
+
+def run_jobs(jobs):
+    """Run the (label, function) pairs in 'jobs' in up to --jobs forked
+    processes, each with its own log prefix.  Return the number of failed
+    jobs."""
+    pending = list(enumerate(jobs, 1))
+    running = {}
+    failed = 0
+    while pending or running:
+        while pending and len(running) < settings.jobs:
+            n, (label, function) = pending.pop(0)
+            pid = os.fork()
+            if pid == 0:
+                # the parent cleans up after itself, and the base system
+                # is saved by the parent, if at all
+                on_panic_hooks.clear()
+                settings.savetgz = None
+                settings.save_end_meta = None
+                phase_timings.clear()
+                set_log_prefix("[job %d]" % n)
+                status = 1
+                try:
+                    function()
+                    log_timing_summary()
+                    status = 0
+                except SystemExit as e:
+                    status = e.code if isinstance(e.code, int) else 1
+                except:
+                    traceback.print_exc(file=sys.stdout)
+                    try:
+                        panic()
+                    except SystemExit:
+                        pass
+                finally:
+                    logging.shutdown()
+                    os._exit(status)
+            logging.info("Started job %d (pid %d): %s" % (n, pid, label))
+            running[pid] = (n, label)
+        pid, status = os.wait()
+        n, label = running.pop(pid)
+        if status == 0:
+            logging.info("Job %d finished: %s" % (n, label))
+        else:
+            logging.error("Job %d failed: %s" % (n, label))
+            failed += 1
+    return failed
+
+
+def process_packages_in_parallel(package_lists):
+    """Test the lists of packages concurrently in separate chroots.  Unless
+    a base tarball (or other base system) is given, the base system is only
+    bootstrapped once and unpacked by every job."""
+    temp_tgz = None
+    if not settings.basetgz and not settings.lvm_volume and not settings.existing_chroot \
+            and not settings.schroot and not settings.docker_image:
+        chroot = get_chroot()
+        chroot.create()
+        temp_tgz = chroot.create_temp_tgz_file()
+
+        def remove_temp_base():
+            # including the reference chroot states cached by the jobs
+            chroot.remove_temp_tgz_file(temp_tgz)
+            remove_files([temp_tgz + suffix for suffix in (".piuparts-meta", ".piuparts-end-meta")
+                          if os.path.exists(temp_tgz + suffix)])
+
+        panic_handler_id = do_on_panic(remove_temp_base)
+        chroot.pack_into_tgz(temp_tgz)
+        chroot.remove()
+        settings.basetgz = temp_tgz
+
+    if settings.batch:
+        count = min(settings.jobs, len(package_lists))
+        jobs = [(" ".join(" ".join(x) for x in package_lists[i::count]),
+                 lambda group=package_lists[i::count]: process_packages_in_batch(group))
+                for i in range(count)]
+    else:
+        jobs = [(" ".join(package_list),
+                 lambda package_list=package_list: process_packages(package_list))
+                for package_list in package_lists]
+    failed = run_jobs(jobs)
+
+    if temp_tgz is not None:
+        settings.basetgz = None
+        remove_temp_base()
+        dont_do_on_panic(panic_handler_id)
+
+    if failed:
+        logging.error("FAIL: %d of %d jobs failed." % (failed, len(jobs)))
+        panic()
+
+
 def main():
     """Main program. But you knew that."""
 
@@ -3341,17 +4911,22 @@ def main():
         else:
             regular_packages_list.append(arg)
 
-    if changes_packages_list:
-        for package_list in changes_packages_list:
-            process_packages(package_list)
-
+    package_lists = list(changes_packages_list)
     if regular_packages_list:
-        if settings.single_packages:
-            for package in regular_packages_list:
-                process_packages([package])
+        if settings.single_packages or settings.batch:
+            package_lists += [[package] for package in regular_packages_list]
         else:
-            process_packages(regular_packages_list)
+            package_lists.append(regular_packages_list)
+
+    if settings.jobs > 1 and len(package_lists) > 1:
+        process_packages_in_parallel(package_lists)
+    elif settings.batch:
+        process_packages_in_batch(package_lists)
+    else:
+        for package_list in package_lists:
+            process_packages(package_list)
 
+    log_timing_summary()
     logging.info("PASS: All tests.")
     logging.info("piuparts run ends.")
 
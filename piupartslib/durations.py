@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+
+# Copyright 2026 piuparts developers
+#
+# This file is part of Piuparts
+#
+# Piuparts is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2 of the License, or (at your
+# option) any later version.
+#
+# Piuparts is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, see <http://www.gnu.org/licenses/>.
+
+
+# Piuparts test duration statistics module
+#
+# The slaves write "Start:" and "End:" stamps into every log, piuparts itself
+# adds "PIUPARTS-TIMING phase=... seconds=..." records. This module collects
+# them into a per section durations.json file, which is updated
+# incrementally: a log is only parsed again if its mtime changed. Entries are
+# kept after the logs are gone (until they are older than 'max_age' days),
+# to be able to show trends over time.
+#
+# Example durations.json:
+#
+# {
+#  "_id": "Piuparts Test Durations",
+#  "_version": "1.0",
+#  "logs": {
+#   "0ad_0.0.26-3": {
+#    "mtime": 1760000000,
+#    "phases": {
+#     "apt-update": 12.3,
+#     "install": 73.1,
+#     ...
+#    },
+#    "seconds": 183,
+#    "start": 1759999817,
+#    "where": "pass"
+#   },
+#   ...
+#  }
+# }
+
+from __future__ import print_function
+
+import calendar
+import json
+import os
+import re
+import time
+
+
+DURID = "Piuparts Test Durations"
+DURVER = "1.0"
+
+START_END_RE = re.compile(r"^(Start|End): (\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) (?:UTC|GMT)$", re.M)
+TIMING_RE = re.compile(r"PIUPARTS-TIMING phase=(\S+) seconds=([0-9.]+)$", re.M)
+
+
+class DurationsException(Exception):
+    pass
+
+
+def new_durations():
+    return {"_id": DURID, "_version": DURVER, "logs": {}}
+
+
+def read_durations(fname):
+    if not os.path.exists(fname):
+        return new_durations()
+
+    with open(fname, "r") as fl:
+        result = json.load(fl)
+
+    if result["_id"] != DURID or result["_version"] != DURVER:
+        raise DurationsException("Durations JSON header mismatch")
+
+    return result
+
+
+def write_durations(durations, fname):
+    with open(fname + ".tmp", "w") as fl:
+        json.dump(durations, fl, sort_keys=True, indent=1)
+    os.rename(fname + ".tmp", fname)
+
+
+def parse_log(logbody):
+    """Return the start time, duration and summed up phase timings of a
+       log, or None if it has no Start/End stamps."""
+
+    stamps = dict((kind, calendar.timegm(time.strptime(stamp, "%Y-%m-%d %H:%M:%S")))
+                  for kind, stamp in START_END_RE.findall(logbody))
+    if "Start" not in stamps or "End" not in stamps:
+        return None
+
+    phases = {}
+    for phase, seconds in TIMING_RE.findall(logbody):
+        phases[phase] = round(phases.get(phase, 0.0) + float(seconds), 1)
+
+    return stamps["Start"], stamps["End"] - stamps["Start"], phases
+
+
+def update_durations(durations, logdict, max_age=365):
+    """Add the logs in logdict (<pkgname>_<version>: <path>) that are new or
+       changed since the last update and expire old entries. Return the
+       number of parsed logs."""
+
+    logs = durations["logs"]
+    count = 0
+    for pkgspec, path in logdict.items():
+        try:
+            mtime = int(os.path.getmtime(path))
+            if pkgspec in logs and logs[pkgspec]["mtime"] == mtime:
+                continue
+            with open(path, "r", errors="backslashreplace") as fl:
+                result = parse_log(fl.read())
+        except (IOError, OSError):
+            # the log was moved or removed meanwhile
+            continue
+        count += 1
+        if result is None:
+            continue
+        start, seconds, phases = result
+        logs[pkgspec] = {
+            "where": os.path.basename(os.path.dirname(path)),
+            "mtime": mtime,
+            "start": start,
+            "seconds": seconds,
+            "phases": phases,
+        }
+
+    if max_age:
+        expired = time.time() - max_age * 86400
+        for pkgspec in [x for x in logs if logs[x]["start"] < expired]:
+            del logs[pkgspec]
+
+    return count
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list."""
+
+    if not values:
+        return 0
+    rank = max(1, int(round(pct / 100.0 * len(values) + 0.5)))
+    return values[min(rank, len(values)) - 1]
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds >= 3600:
+        return "%dh%02dm" % (seconds // 3600, seconds % 3600 // 60)
+    if seconds >= 60:
+        return "%dm%02ds" % (seconds // 60, seconds % 60)
+    return "%ds" % seconds
+
+
+def format_stats(values):
+    values = sorted(values)
+    return "n=%d median=%s p90=%s p99=%s max=%s" % (
+        len(values),
+        format_duration(percentile(values, 50)),
+        format_duration(percentile(values, 90)),
+        format_duration(percentile(values, 99)),
+        format_duration(values[-1] if values else 0))
+
+
+def get_package_durations(durations):
+    """Return a dict <pkgname>: [seconds, ...] with the durations of the
+       tests of each package, oldest first."""
+
+    result = {}
+    logs = durations["logs"]
+    for pkgspec in sorted(logs, key=lambda x: logs[x]["start"]):
+        result.setdefault(pkgspec.split("_", 1)[0], []).append(logs[pkgspec]["seconds"])
+    return result
+
+
+def get_adaptive_timeout(seconds, factor, minimum, maximum, pct=99):
+    """Return a timeout derived from the durations of previous tests of a
+       package: the percentile times factor, limited to [minimum, maximum].
+       Return None if there are no previous tests."""
+
+    if not seconds:
+        return None
+    timeout = int(percentile(sorted(seconds), pct) * factor)
+    return max(minimum, min(maximum, timeout))
+
+
+def report(durations, section, slowest=20):
+    """Return the lines of a plain text duration report for a section."""
+
+    logs = durations["logs"]
+    seconds = [x["seconds"] for x in logs.values()]
+    lines = ["Section %s: %d logs, %s in total" % (
+        section, len(logs), format_duration(sum(seconds)))]
+    if not logs:
+        return lines
+    lines.append("  all:    " + format_stats(seconds))
+    for where in sorted(set(x["where"] for x in logs.values())):
+        lines.append("  %-7s " % (where + ":") +
+                     format_stats([x["seconds"] for x in logs.values() if x["where"] == where]))
+
+    lines.append("  slowest packages:")
+    for pkgspec in sorted(logs, key=lambda x: (-logs[x]["seconds"], x))[:slowest]:
+        lines.append("    %-50s %8s  %s" % (pkgspec, format_duration(logs[pkgspec]["seconds"]),
+                                             logs[pkgspec]["where"]))
+
+    phases = {}
+    for entry in logs.values():
+        for phase, secs in entry["phases"].items():
+            phases.setdefault(phase, []).append(secs)
+    if phases:
+        lines.append("  phases (total, per log):")
+        for phase in sorted(phases, key=lambda x: -sum(phases[x])):
+            lines.append("    %-24s %8s  %s" % (phase, format_duration(sum(phases[phase])),
+                                                 format_stats(phases[phase])))
+
+    months = {}
+    for entry in logs.values():
+        month = time.strftime("%Y-%m", time.gmtime(entry["start"]))
+        months.setdefault(month, []).append(entry["seconds"])
+    lines.append("  trend (by month of the test):")
+    for month in sorted(months):
+        lines.append("    %s  %s" % (month, format_stats(months[month])))
+
+    return lines
+
+# vi:set et ts=4 sw=4 :
@@ -39,6 +39,7 @@ except ImportError:
 import apt_pkg
 
 import piupartslib
+import piupartslib.durations
 from piupartslib.dependencyparser import DependencyParser
 
 import six
@@ -389,6 +390,7 @@ class PackagesDB:
         self._recycle_mode = False
         self._candidates_for_testing = None
         self._rdeps = None
+        self._durations = None
         self.set_subdirs(ok="pass", fail="fail", evil="untestable",
                          reserved="reserved", morefail=["bugged", "affected"],
                          recycle="recycle")
@@ -401,6 +403,7 @@ class PackagesDB:
         else:
             pformat = "%s"
         self._submissions = pformat % "submissions.txt"
+        self._durations_file = pformat % "durations.json"
         self._all = []
         if ok:
             self._ok = pformat % ok
@@ -821,16 +824,44 @@ class PackagesDB:
                 return state
         return package_state
 
+    def get_package_durations(self, package_name):
+        # durations of previous tests as collected by gather_test_durations
+        if self._durations is None:
+            try:
+                durations = piupartslib.durations.read_durations(self._durations_file)
+            except (ValueError, KeyError, piupartslib.durations.DurationsException):
+                logging.info("ignoring invalid %s" % self._durations_file)
+                durations = piupartslib.durations.new_durations()
+            self._durations = piupartslib.durations.get_package_durations(durations)
+        return self._durations.get(package_name, [])
+
+    def get_expected_duration(self, package_name):
+        durations = self.get_package_durations(package_name)
+        if durations:
+            return durations[-1]
+        return None
+
+    def _get_cost_class(self, package_name):
+        # 0: < 4 minutes (or unknown), 1: < 16 minutes, 2: < 64 minutes, ...
+        cost_class = 0
+        expected = self.get_expected_duration(package_name) or 0
+        while expected >= 240:
+            expected /= 4
+            cost_class += 1
+        return cost_class
+
     def _get_package_weight(self, p):
         # compute the priority of a package that needs testing
         # result will be used as a reverse sorting key, so higher is earlier
         waiting_count = self.waiting_count(p["Package"])
         rdep_chain_len = self.rdep_chain_len(p["Package"])
+        cost_class = self._get_cost_class(p["Package"])
 
         if not self._recycle_mode:
             return (
                 min(rdep_chain_len, waiting_count),
                     waiting_count,
+                    -cost_class,  # prefer cheap packages
             )
 
         try:
@@ -845,6 +876,7 @@ class PackagesDB:
             min(rdep_chain_len, waiting_count),
                 waiting_count,
                 not self._logdb.log_exists(p, [self._ok]),  # prefer problematic logs
+                -cost_class,  # prefer cheap packages
                 -ctime / 3600,  # prefer older, at 1 hour granularity to allow randomization
                 -mtime / 3600,  # prefer older, at 1 hour granularity to allow randomization
         )
@@ -866,8 +898,11 @@ class PackagesDB:
     def _remove_unavailable_candidate(self, p):
         self._candidates_for_testing.remove(p)
 
-    def reserve_package(self):
+    def reserve_package(self, max_expected_duration=None):
         for p in self._find_packages_ready_for_testing():
+            if max_expected_duration and \
+                    (self.get_expected_duration(p.name()) or 0) >= max_expected_duration:
+                continue
             if self._logdb.log_exists(p, [self._reserved]):
                 self._remove_unavailable_candidate(p)
                 continue
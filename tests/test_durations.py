@@ -0,0 +1,140 @@
+import unittest
+import shutil
+import tempfile
+import time
+import os
+
+import piupartslib.durations as durations
+
+
+LOG = """Start: 2026-01-10 12:00:00 UTC
+
+Executing: sudo piuparts ...
+0m3.1s INFO: PIUPARTS-TIMING phase=apt-update seconds=10.5
+0m9.8s INFO: PIUPARTS-TIMING phase=install seconds=40.0
+0m9.9s INFO: PIUPARTS-TIMING phase=apt-update seconds=2.0
+0m9.9s INFO: PIUPARTS-TIMING-SUMMARY install=40.0 apt-update=12.5
+
+End: 2026-01-10 12:03:20 UTC
+"""
+
+
+class DurationsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.testdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.testdir, "pass"))
+        os.mkdir(os.path.join(self.testdir, "fail"))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write_log(self, where, pkgspec, body, start=None):
+        path = os.path.join(self.testdir, where, pkgspec + ".log")
+        with open(path, "w") as f:
+            f.write(body)
+        if start is not None:
+            os.utime(path, (start, start))
+        return path
+
+    def testParseLog(self):
+        start, seconds, phases = durations.parse_log(LOG)
+        self.assertEqual(start, 1768046400)
+        self.assertEqual(seconds, 200)
+        self.assertEqual(phases, {"apt-update": 12.5, "install": 40.0})
+
+        self.assertIsNone(durations.parse_log("Start: 2026-01-10 12:00:00 UTC\n"))
+        self.assertIsNone(durations.parse_log(""))
+
+    def testPercentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(durations.percentile(values, 50), 50)
+        self.assertEqual(durations.percentile(values, 90), 90)
+        self.assertEqual(durations.percentile(values, 100), 100)
+        self.assertEqual(durations.percentile([7], 99), 7)
+        self.assertEqual(durations.percentile([], 50), 0)
+
+    def testFormatDuration(self):
+        self.assertEqual(durations.format_duration(42), "42s")
+        self.assertEqual(durations.format_duration(200), "3m20s")
+        self.assertEqual(durations.format_duration(3 * 3600 + 5 * 60), "3h05m")
+
+    def testUpdateIncremental(self):
+        now = int(time.time())
+        body = LOG.replace("2026-01-10", time.strftime("%Y-%m-%d", time.gmtime(now)))
+        logdict = {
+            "foo_1.0": self.write_log("pass", "foo_1.0", body),
+            "bar_2.0": self.write_log("fail", "bar_2.0", "no stamps\n"),
+        }
+        dur = durations.new_durations()
+        self.assertEqual(durations.update_durations(dur, logdict), 2)
+        self.assertEqual(list(dur["logs"].keys()), ["foo_1.0"])
+        self.assertEqual(dur["logs"]["foo_1.0"]["where"], "pass")
+        self.assertEqual(dur["logs"]["foo_1.0"]["seconds"], 200)
+
+        # unchanged logs are skipped, rewritten logs are parsed again
+        fname = os.path.join(self.testdir, "durations.json")
+        durations.write_durations(dur, fname)
+        dur = durations.read_durations(fname)
+        self.assertEqual(durations.update_durations(dur, {"foo_1.0": logdict["foo_1.0"]}), 0)
+        os.utime(logdict["foo_1.0"], (now + 10, now + 10))
+        self.assertEqual(durations.update_durations(dur, logdict), 2)
+
+        # removed logs are remembered
+        os.unlink(logdict["foo_1.0"])
+        self.assertEqual(durations.update_durations(dur, {}), 0)
+        self.assertIn("foo_1.0", dur["logs"])
+        self.assertEqual(durations.get_package_durations(dur), {"foo": [200]})
+
+    def testPackageDurations(self):
+        dur = durations.new_durations()
+        dur["logs"] = {
+            "foo_2": {"where": "pass", "mtime": 0, "start": 2000, "seconds": 50, "phases": {}},
+            "foo_1": {"where": "fail", "mtime": 0, "start": 1000, "seconds": 70, "phases": {}},
+            "foo-bar_1": {"where": "pass", "mtime": 0, "start": 1500, "seconds": 9, "phases": {}},
+        }
+        self.assertEqual(durations.get_package_durations(dur),
+                         {"foo": [70, 50], "foo-bar": [9]})
+
+    def testAdaptiveTimeout(self):
+        self.assertIsNone(durations.get_adaptive_timeout([], 3, 600, 5400))
+        self.assertEqual(durations.get_adaptive_timeout([40, 35], 3, 600, 5400), 600)
+        self.assertEqual(durations.get_adaptive_timeout([400, 300, 500], 3, 600, 5400), 1500)
+        self.assertEqual(durations.get_adaptive_timeout([3000], 3, 600, 5400), 5400)
+        self.assertEqual(durations.get_adaptive_timeout(list(range(1, 201)), 2, 0, 5400), 396)
+
+    def testExpire(self):
+        logdict = {"old_1": self.write_log("pass", "old_1", LOG.replace("2026-01-10", "2000-01-10"))}
+        dur = durations.new_durations()
+        durations.update_durations(dur, logdict)
+        self.assertEqual(dur["logs"], {})
+        durations.update_durations(dur, logdict, max_age=0)
+        self.assertIn("old_1", dur["logs"])
+
+    def testReadBadHeader(self):
+        fname = os.path.join(self.testdir, "durations.json")
+        dur = durations.new_durations()
+        dur["_version"] = "0.0"
+        durations.write_durations(dur, fname)
+        with self.assertRaises(durations.DurationsException):
+            durations.read_durations(fname)
+        self.assertEqual(durations.read_durations(fname + ".missing"),
+                         durations.new_durations())
+
+    def testReport(self):
+        dur = durations.new_durations()
+        self.assertEqual(durations.report(dur, "sid"),
+                         ["Section sid: 0 logs, 0s in total"])
+        dur["logs"] = {
+            "fast_1": {"where": "pass", "mtime": 0, "start": 1768046400,
+                       "seconds": 30, "phases": {"install": 20.0}},
+            "slow_1": {"where": "fail", "mtime": 0, "start": 1770724800,
+                       "seconds": 4000, "phases": {"install": 3900.0}},
+        }
+        lines = durations.report(dur, "sid", slowest=1)
+        self.assertEqual(lines[0], "Section sid: 2 logs, 1h07m in total")
+        self.assertIn("  slowest packages:", lines)
+        self.assertTrue(lines[lines.index("  slowest packages:") + 1].strip().startswith("slow_1"))
+        self.assertFalse(any(x.strip().startswith("fast_1") for x in lines))
+        self.assertTrue(any(x.startswith("    2026-01 ") for x in lines))
+        self.assertTrue(any(x.startswith("    2026-02 ") for x in lines))
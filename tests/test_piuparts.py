@@ -1,7 +1,12 @@
 import os
+import pickle
 import shutil
+import signal
+import stat
+import subprocess
+import time
 import unittest
-from unittest.mock import patch
+from unittest.mock import DEFAULT, Mock, patch
 
 import piuparts
 from piuparts import is_broken_symlink
@@ -171,6 +176,18 @@ class IsBrokenSymlinkTests(unittest.TestCase):
         self.failIf(is_broken_symlink(self.testdir, self.testdir,
                                       "trailing-slash-works"))
 
+    def testSharedCacheGivesSameResults(self):
+        cache = {}
+        for pathname in self.symlinks:
+            name = pathname[len(self.testdir) + 1:]
+            self.assertEqual(is_broken_symlink(self.testdir, self.testdir, name, cache=cache),
+                             is_broken_symlink(self.testdir, self.testdir, name))
+        # and again, now answered (partially) from the cache
+        for pathname in self.symlinks:
+            name = pathname[len(self.testdir) + 1:]
+            self.assertEqual(is_broken_symlink(self.testdir, self.testdir, name, cache=cache),
+                             is_broken_symlink(self.testdir, self.testdir, name))
+
     def testMultiLevelNestedSymlinks(self):
         # target/first-link -> ../target/second-link -> ../target
 
@@ -190,3 +207,918 @@ class IsBrokenSymlinkTests(unittest.TestCase):
         self.symlink("/final-dir", "second-link")
         self.failIf(is_broken_symlink(self.testdir, self.testdir,
                                       "first-link"))
+
+
+class ScanTreeMetaDataTests(unittest.TestCase):
+
+    testdir = "scan-tree-meta-data-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.mkdir(self.testdir)
+        os.makedirs(os.path.join(self.testdir, "dir/subdir"))
+        os.makedirs(os.path.join(self.testdir, "proc/1"))
+        with open(os.path.join(self.testdir, "dir/file"), "w") as f:
+            f.write("content")
+        os.symlink("file", os.path.join(self.testdir, "dir/link"))
+        os.symlink("dir", os.path.join(self.testdir, "dir-link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_scan_tree_meta_data_records_all_objects(self):
+        tree = piuparts.scan_tree_meta_data(self.testdir, skip=["/proc/"])
+        self.assertEqual(sorted(tree.keys()),
+                         ["/", "/dir/", "/dir/file", "/dir/link", "/dir/subdir/"])
+        self.assertEqual(tree["/dir/file"].st.st_size, 7)
+        self.assertEqual(tree["/dir/link"].target, "file")
+        self.assertIsNone(tree["/dir/file"].target)
+
+    def test_scan_tree_meta_data_maps_users_and_groups(self):
+        uid = os.lstat(self.testdir).st_uid
+        tree = piuparts.scan_tree_meta_data(self.testdir, uidmap={uid: "someone"})
+        self.assertEqual(tree["/dir/file"].user, "someone")
+        self.assertEqual(tree["/dir/file"].group, "#%d" % os.lstat(self.testdir).st_gid)
+
+    def test_scan_tree_meta_data_threads_give_same_result(self):
+        tree = piuparts.scan_tree_meta_data(self.testdir)
+        threaded = piuparts.scan_tree_meta_data(self.testdir, threads=2)
+        self.assertEqual(dict(tree), dict(threaded))
+
+    def test_diff_meta_data_finds_modified_file(self):
+        before = piuparts.scan_tree_meta_data(self.testdir, skip=["/proc/"])
+        with open(os.path.join(self.testdir, "dir/file"), "a") as f:
+            f.write("more")
+        os.remove(os.path.join(self.testdir, "dir/link"))
+        with open(os.path.join(self.testdir, "dir/new"), "w") as f:
+            f.write("new")
+        after = piuparts.scan_tree_meta_data(self.testdir, skip=["/proc/"])
+        (new, removed, modified) = piuparts.diff_meta_data(before, after, quiet=True)
+        self.assertEqual([name for name, info in new], ["/dir/new"])
+        self.assertEqual([name for name, info in removed], ["/dir/link"])
+        self.assertEqual([name for name, info in modified], ["/dir/file"])
+
+
+class ReferenceChrootStateTests(unittest.TestCase):
+
+    testdir = "reference-chroot-state-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.mkdir(self.testdir)
+        piuparts.settings.basetgz = os.path.join(self.testdir, "base.tgz")
+        piuparts.settings.reference_meta_cache = True
+        with open(piuparts.settings.basetgz, "w") as f:
+            f.write("not really a tarball")
+        self.chroot = Mock()
+        self.chroot.initial_selections = None
+        self.chroot.avail_md5_history = ["0123"]
+        self.chroot.get_selections.return_value = {"dpkg": ("install", "1.0")}
+        self.chroot.get_state_meta_data.side_effect = lambda: {
+            "initial_selections": None,
+            "avail_md5": ["0123"],
+            "tree": {},
+            "selections": {"dpkg": ("install", "1.0")},
+            "diversions": [],
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_get_reference_chroot_state_reuses_cached_state(self):
+        state = piuparts.get_reference_chroot_state(self.chroot)
+        cached = piuparts.get_reference_chroot_state(self.chroot)
+        self.assertEqual(self.chroot.get_state_meta_data.call_count, 1)
+        self.assertEqual(dict(cached["tree"]), state["tree"])
+        self.assertEqual(cached, state)
+
+    def test_get_reference_chroot_state_detects_changed_selections(self):
+        piuparts.get_reference_chroot_state(self.chroot)
+        self.chroot.get_selections.return_value = {"dpkg": ("install", "1.1")}
+        piuparts.get_reference_chroot_state(self.chroot)
+        self.assertEqual(self.chroot.get_state_meta_data.call_count, 2)
+
+    def test_get_reference_chroot_state_detects_changed_basetgz(self):
+        piuparts.get_reference_chroot_state(self.chroot)
+        with open(piuparts.settings.basetgz, "a") as f:
+            f.write("modified")
+        piuparts.get_reference_chroot_state(self.chroot)
+        self.assertEqual(self.chroot.get_state_meta_data.call_count, 2)
+
+    def test_get_reference_chroot_state_checks_initial_selections(self):
+        piuparts.get_reference_chroot_state(self.chroot)
+        self.chroot.initial_selections = {"dpkg": ("install", "1.0")}
+        state = piuparts.get_reference_chroot_state(self.chroot)
+        self.assertEqual(self.chroot.get_state_meta_data.call_count, 2)
+        self.assertIsNone(state["initial_selections"])
+
+    def test_basetgz_is_hashed_once(self):
+        piuparts.file_identities.clear()
+        with patch.object(piuparts.hashlib, "sha256", wraps=piuparts.hashlib.sha256) as sha256:
+            piuparts.get_reference_chroot_state(self.chroot)
+            piuparts.get_reference_chroot_state(self.chroot)
+        self.assertEqual(sha256.call_count, 1)
+
+    def test_upgraded_reference_chroot_state_is_cached(self):
+        piuparts.settings.debian_distros = ["buster", "bullseye"]
+        self.assertFalse(piuparts.have_upgraded_reference_chroot_state())
+        self.assertIsNone(piuparts.load_upgraded_reference_chroot_state(self.chroot))
+        with patch.object(piuparts, "get_chroot", return_value=self.chroot):
+            state = piuparts.create_upgraded_reference_chroot_state()
+        self.chroot.upgrade_to_distros.assert_called_once_with(["bullseye"], [])
+        self.assertEqual(self.chroot.remove.call_count, 1)
+        self.assertTrue(piuparts.have_upgraded_reference_chroot_state())
+        cached = piuparts.load_upgraded_reference_chroot_state(self.chroot)
+        self.assertEqual(dict(cached["tree"]), state["tree"])
+        self.assertEqual(cached, state)
+
+    def test_upgraded_reference_chroot_state_detects_changes(self):
+        piuparts.settings.debian_distros = ["buster", "bullseye"]
+        with patch.object(piuparts, "get_chroot", return_value=self.chroot):
+            piuparts.create_upgraded_reference_chroot_state()
+        self.chroot.avail_md5_history = ["0123", "4567"]
+        self.assertIsNone(piuparts.load_upgraded_reference_chroot_state(self.chroot))
+        self.chroot.avail_md5_history = ["0123"]
+        self.chroot.initial_selections = {"dpkg": ("install", "1.0")}
+        self.assertIsNone(piuparts.load_upgraded_reference_chroot_state(self.chroot))
+        self.assertTrue(piuparts.have_upgraded_reference_chroot_state())
+
+
+class ChrootScanTests(unittest.TestCase):
+
+    testdir = "chroot-scan-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.mkdir(self.testdir)
+        os.makedirs(os.path.join(self.testdir, "etc"))
+        os.makedirs(os.path.join(self.testdir, "usr/lib"))
+        with open(os.path.join(self.testdir, "etc/passwd"), "w") as f:
+            f.write("root:x:0:0:root:/root:/bin/sh\n")
+        with open(os.path.join(self.testdir, "etc/group"), "w") as f:
+            f.write("root:x:0:\n")
+        os.symlink("usr/lib", os.path.join(self.testdir, "lib"))
+        os.symlink("../etc/passwd", os.path.join(self.testdir, "usr/works"))
+        os.symlink("/lib/notexist", os.path.join(self.testdir, "usr/broken"))
+        self.chroot = piuparts.Chroot()
+        self.chroot.name = self.testdir
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_scan_finds_broken_symlinks(self):
+        scan = self.chroot.scan(clean=False)
+        self.assertEqual(scan.broken_symlinks, ["/usr/broken"])
+        self.assertIn("/usr/works", scan.tree)
+        self.assertIn("/etc/passwd", scan.tree)
+
+    def test_scan_skips_symlink_check_if_disabled(self):
+        piuparts.settings.check_broken_symlinks = False
+        scan = self.chroot.scan(clean=False)
+        self.assertEqual(scan.broken_symlinks, [])
+
+    def write_dpkg_list(self, package, pathnames):
+        infodir = os.path.join(self.testdir, "var/lib/dpkg/info")
+        if not os.path.isdir(infodir):
+            os.makedirs(infodir)
+        with open(os.path.join(infodir, package + ".list"), "w") as f:
+            f.write("\n".join(pathnames) + "\n")
+
+    def test_list_paths_with_symlinks_allows_usr_merge(self):
+        self.write_dpkg_list("foo", ["/lib", "/lib/foo", "/usr/works"])
+        with patch.object(piuparts, "panic", side_effect=SystemExit) as panic_mock:
+            self.chroot.list_paths_with_symlinks(scan=self.chroot.scan(clean=False))
+            self.chroot.list_paths_with_symlinks()
+            panic_mock.assert_not_called()
+
+    def test_list_paths_with_symlinks_fails_on_directory_symlink(self):
+        os.symlink("etc", os.path.join(self.testdir, "etc-link"))
+        self.write_dpkg_list("foo", ["/etc-link", "/etc-link/foo.conf"])
+        self.write_dpkg_list("bar", ["/etc/foo.conf"])
+        for scan in [self.chroot.scan(clean=False), None]:
+            with patch.object(piuparts, "panic", side_effect=SystemExit) as panic_mock:
+                with self.assertRaises(SystemExit):
+                    self.chroot.list_paths_with_symlinks(scan=scan)
+                panic_mock.assert_called_once()
+
+
+class IgnoreMatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.matcher = piuparts.IgnoreMatcher(
+            ["/etc/hosts", ":/etc/passwd", "/var/log/"],
+            ["/dev/.*", ":/usr/share/doc/.*", "/var/lib/vmm/(./.*)?", "/a/b|/c/d"])
+
+    def test_match_ignored_files(self):
+        self.assertEqual(self.matcher.match("/etc/hosts"), False)
+        self.assertEqual(self.matcher.match("/etc/passwd"), True)
+        self.assertEqual(self.matcher.match("/var/log/"), False)
+        self.assertIsNone(self.matcher.match("/var/log"))
+
+    def test_match_patterns_match_whole_name(self):
+        self.assertEqual(self.matcher.match("/dev/null"), False)
+        self.assertEqual(self.matcher.match("/usr/share/doc/foo/copyright"), True)
+        self.assertEqual(self.matcher.match("/var/lib/vmm/"), False)
+        self.assertEqual(self.matcher.match("/var/lib/vmm/x/y"), False)
+        self.assertEqual(self.matcher.match("/c/d"), False)
+        self.assertIsNone(self.matcher.match("/devices"))
+        self.assertIsNone(self.matcher.match("/srv/dev/null"))
+
+    def test_search_patterns_match_anywhere(self):
+        self.assertEqual(self.matcher.search("/srv/dev/null"), False)
+        self.assertEqual(self.matcher.search("/x/usr/share/doc/foo"), True)
+        self.assertIsNone(self.matcher.search("/devices"))
+
+    def test_patterns_with_flags_and_backreferences(self):
+        matcher = piuparts.IgnoreMatcher([], ["(?i)/foo", "/(a)/x", "/(b)/\\1", ":/usr/.*"])
+        self.assertEqual(matcher.match("/FOO"), False)
+        self.assertEqual(matcher.search("/srv/Foo/bar"), False)
+        self.assertEqual(matcher.match("/b/b"), False)
+        self.assertEqual(matcher.search("/b/b"), False)
+        self.assertIsNone(matcher.match("/b/a"))
+        self.assertEqual(matcher.match("/a/x"), False)
+        self.assertEqual(matcher.match("/usr/bin/foo"), True)
+
+    def test_is_ignored_uses_settings(self):
+        piuparts.settings = piuparts.Settings()
+        chroot = piuparts.Chroot()
+        self.assertTrue(chroot.is_ignored("/etc/passwd"))
+        self.assertTrue(chroot.is_ignored("/var/lib/apt/lists/lock"))
+        self.assertFalse(chroot.is_ignored("/usr/bin/piuparts"))
+        piuparts.settings.ignored_patterns.append("/usr/bin/.*")
+        self.assertTrue(chroot.is_ignored("/usr/bin/piuparts"))
+
+
+class DiffMetaDataTests(unittest.TestCase):
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+
+    def info(self, target=None, size=0):
+        mode = stat.S_IFLNK | 0o777 if target else stat.S_IFREG | 0o644
+        return piuparts.FileInfo(piuparts.StatInfo(mode, 0, 0, size), target, "root", "root")
+
+    def test_diff_meta_data_prunes_renamed_rc_links(self):
+        tree1 = {
+            "/etc/rc2.d/S01foo": self.info("../init.d/foo"),
+            "/etc/rc2.d/S01bar": self.info("../init.d/bar"),
+            "/etc/rc3.d/K01foo": self.info("../init.d/foo"),
+            "/etc/rc5.d/S01baz": self.info("../init.d/baz"),
+        }
+        tree2 = {
+            "/etc/rc2.d/S03foo": self.info("../init.d/foo"),
+            "/etc/rc2.d/S02bar": self.info("../init.d/bar"),
+            "/etc/rc3.d/K05foo": self.info("../init.d/foo"),
+            "/etc/rc5.d/S02baz.dpkg-new": self.info("../init.d/baz"),
+        }
+        (new, removed, modified) = piuparts.diff_meta_data(tree1, tree2)
+        self.assertEqual([name for name, info in new], ["/etc/rc5.d/S02baz.dpkg-new"])
+        self.assertEqual([name for name, info in removed], ["/etc/rc5.d/S01baz"])
+        self.assertEqual(modified, [])
+
+    def test_diff_meta_data_pairs_each_rc_link_once(self):
+        tree1 = {"/etc/rc2.d/S01foo": self.info("../init.d/foo")}
+        tree2 = {
+            "/etc/rc2.d/S02foo": self.info("../init.d/foo"),
+            "/etc/rc2.d/K03foo": self.info("../init.d/foo"),
+        }
+        (new, removed, modified) = piuparts.diff_meta_data(tree1, tree2)
+        self.assertEqual([name for name, info in new], ["/etc/rc2.d/K03foo"])
+        self.assertEqual(removed, [])
+
+
+class FilesOwnedByPackagesTests(unittest.TestCase):
+
+    testdir = "files-owned-by-packages-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.makedirs(os.path.join(self.testdir, "var/lib/dpkg/info"))
+        self.chroot = piuparts.Chroot()
+        self.chroot.name = self.testdir
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write_dpkg_list(self, package, pathnames):
+        filename = os.path.join(self.testdir, "var/lib/dpkg/info", package + ".list")
+        with open(filename + ".new", "w") as f:
+            f.write("\n".join(pathnames) + "\n")
+        os.rename(filename + ".new", filename)
+
+    def test_get_files_owned_by_packages(self):
+        self.write_dpkg_list("foo", ["/.", "/usr", "/usr/bin/foo"])
+        self.write_dpkg_list("bar", ["/.", "/usr", "/usr/bin/bar"])
+        owners = self.chroot.get_files_owned_by_packages()
+        self.assertEqual(sorted(owners["/usr"]), ["bar", "foo"])
+        self.assertEqual(owners["/usr/bin/foo"], ["foo"])
+        self.assertNotIn("/usr/bin", owners)
+
+    def test_get_files_owned_by_packages_refreshes_changed_lists(self):
+        self.write_dpkg_list("foo", ["/.", "/usr", "/usr/bin/foo"])
+        self.write_dpkg_list("bar", ["/.", "/usr", "/usr/bin/bar"])
+        before = self.chroot.get_files_owned_by_packages()
+        self.write_dpkg_list("foo", ["/.", "/usr", "/usr/sbin/foo"])
+        os.remove(os.path.join(self.testdir, "var/lib/dpkg/info/bar.list"))
+        after = self.chroot.get_files_owned_by_packages()
+        self.assertEqual(after, {"/.": ["foo"], "/usr": ["foo"], "/usr/sbin/foo": ["foo"]})
+        # earlier results are not modified
+        self.assertEqual(sorted(before["/usr"]), ["bar", "foo"])
+        self.assertIn("/usr/bin/foo", before)
+
+    def test_get_files_owned_by_packages_duplicate_paths(self):
+        self.write_dpkg_list("foo", ["/.", "/usr", "/usr/bin/foo", "/usr/bin/foo"])
+        self.chroot.get_files_owned_by_packages()
+        os.remove(os.path.join(self.testdir, "var/lib/dpkg/info/foo.list"))
+        self.assertEqual(self.chroot.get_files_owned_by_packages(), {})
+
+
+class DpkgStatusTests(unittest.TestCase):
+
+    testdir = "dpkg-status-testdir"
+
+    status = """Package: dpkg
+Status: install ok installed
+Architecture: amd64
+Version: 1.21.22
+
+Package: libfoo1
+Status: install ok installed
+Architecture: amd64
+Multi-Arch: same
+Version: 1.0-1
+Description: foo library
+ with a continuation line
+
+Package: libfoo1
+Status: install ok installed
+Architecture: i386
+Multi-Arch: same
+Version: 1.0-1
+
+Package: bar
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 2.0-1
+
+Package: baz
+Status: install ok half-configured
+Architecture: i386
+Version: 3.0-1
+
+Package: purged
+Status: purge ok not-installed
+Architecture: all
+"""
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.makedirs(os.path.join(self.testdir, "var/lib/dpkg/updates"))
+        with open(os.path.join(self.testdir, "var/lib/dpkg/status"), "w") as f:
+            f.write(self.status)
+        self.chroot = piuparts.Chroot()
+        self.chroot.name = self.testdir
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_get_selections(self):
+        self.assertEqual(self.chroot.get_selections(), {
+            "dpkg": ("install", "1.21.22"),
+            "libfoo1:amd64": ("install", "1.0-1"),
+            "libfoo1:i386": ("install", "1.0-1"),
+            "bar": ("deinstall", None),
+            "baz:i386": ("install", "3.0-1"),
+        })
+
+    def test_is_installed(self):
+        self.assertTrue(self.chroot.is_installed(["dpkg", "libfoo1"]))
+        self.assertFalse(self.chroot.is_installed(["dpkg", "baz"]))
+        self.assertFalse(self.chroot.is_installed(["dpkg", "unknown"]))
+
+    def test_get_package_version(self):
+        self.assertEqual(self.chroot.get_package_version("dpkg"), "1.21.22")
+        self.assertEqual(self.chroot.get_package_version("unknown"), "")
+
+    def test_blank_lines_and_stanzas_without_status(self):
+        with open(os.path.join(self.testdir, "var/lib/dpkg/status"), "w") as f:
+            f.write("Package: nostatus\nArchitecture: amd64\n\n\n" + self.status)
+        self.assertEqual(sorted(self.chroot.get_selections()),
+                         ["bar", "baz:i386", "dpkg", "libfoo1:amd64", "libfoo1:i386"])
+
+    def test_pending_updates_fall_back_to_dpkg_query(self):
+        with open(os.path.join(self.testdir, "var/lib/dpkg/updates/0000"), "w") as f:
+            f.write("Package: dpkg\n")
+        self.chroot.run = Mock(return_value=(0, "install ok installed\tdpkg\tdpkg\t1.21.23\n"))
+        self.assertEqual(self.chroot.get_selections(), {"dpkg": ("install", "1.21.23")})
+        self.assertEqual(self.chroot.run.call_args[0][0][0], "dpkg-query")
+
+
+class GetKnownPackagesTests(unittest.TestCase):
+
+    output = """Package: foo
+Architecture: amd64
+Version: 1.0-1
+Description: foo
+ Package: not-a-field
+Filename: pool/main/f/foo/foo_1.0-1_amd64.deb
+SHA256: 0123
+
+Package: libbar1
+Architecture: i386
+Version: 2.0-1
+Filename: pool/main/b/bar/libbar1_2.0-1_i386.deb
+
+Package: removed
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 0.1
+
+"""
+
+    single = {
+        "foo=1.0-1": "Package: foo\nFilename: pool/main/f/foo/foo_1.0-1_amd64.deb\n",
+        "removed": "Package: removed\nStatus: deinstall ok config-files\n",
+    }
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        self.chroot = piuparts.Chroot()
+        self.chroot.run = Mock(side_effect=self.apt_cache)
+
+    def apt_cache(self, command, ignore_errors=False):
+        if command[0] == "sh":
+            return (0, self.output)
+        if command[-1] in self.single:
+            return (0, self.single[command[-1]])
+        return (100, "")
+
+    def test_single_apt_cache_call(self):
+        known = self.chroot.get_known_packages(["foo", "libbar1:i386", "foo"])
+        self.assertEqual(known, ["foo", "libbar1:i386", "foo"])
+        self.assertEqual(self.chroot.run.call_count, 1)
+        self.assertEqual(self.chroot.run.call_args[0][0][-3:], ["foo", "libbar1:i386", "foo"])
+
+    def test_unresolved_queries_are_checked_one_by_one(self):
+        known = self.chroot.get_known_packages(["foo", "removed", "virtual", "foo=1.0-1"])
+        self.assertEqual(known, ["foo", "foo=1.0-1"])
+        self.assertEqual([c[0][0][-1] for c in self.chroot.run.call_args_list[1:]],
+                         ["removed", "virtual", "foo=1.0-1"])
+
+    def test_no_packages(self):
+        self.assertEqual(self.chroot.get_known_packages([]), [])
+        self.chroot.run.assert_not_called()
+
+
+class ChrootAgentTests(unittest.TestCase):
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.testobjects = ["foo", "bar"]
+        self.agent = piuparts.ChrootAgent(["sh"])
+
+    def tearDown(self):
+        self.agent.stop()
+
+    def test_run(self):
+        self.assertEqual(self.agent.run(["echo", "hello world"], ["x"]), (0, "hello world\n"))
+        self.assertEqual(self.agent.run(["sh", "-c", "printf abc; exit 3"], ["x"], ignore_errors=True), (3, "abc"))
+        self.assertEqual(self.agent.run(["sh", "-c", "echo $PIUPARTS_OBJECTS; cat"], ["x"]), (0, "foo bar\n"))
+        self.assertEqual(self.agent.run(["printf", "a\r\nb\rc"], ["x"]), (0, "a\nb\nc"))
+
+    @patch.dict(os.environ, {"PIUPARTS_TEST": "install", "PIUPARTS_PHASE": "install"})
+    def test_environment_follows_os_environ(self):
+        command = ["sh", "-c", "echo TEST=$PIUPARTS_TEST PHASE=${PIUPARTS_PHASE-unset}"]
+        self.assertEqual(self.agent.run(command, ["x"]), (0, "TEST=install PHASE=install\n"))
+        os.environ["PIUPARTS_TEST"] = "upgrade"
+        del os.environ["PIUPARTS_PHASE"]
+        self.assertEqual(self.agent.run(command, ["x"]), (0, "TEST=upgrade PHASE=unset\n"))
+        os.environ["PIUPARTS_TEST"] = "it's \"quoted\""
+        self.assertEqual(self.agent.run(command, ["x"]), (0, "TEST=it's \"quoted\" PHASE=unset\n"))
+
+    @patch("piuparts.panic")
+    def test_runtime_limit(self, panic):
+        status, output = self.agent.run(["sleep", "10"], ["x"], ignore_errors=True, timeout=1)
+        self.assertNotEqual(status, 0)
+        self.assertIn("exceeding runtime limit", output)
+        panic.assert_called_once_with()
+        self.assertIsNone(self.agent.process)
+        self.assertEqual(self.agent.run(["echo", "again"], ["x"]), (0, "again\n"))
+
+    @patch("piuparts.panic")
+    def test_output_limit(self, panic):
+        piuparts.settings.max_command_output_size = 100000
+        status, output = self.agent.run(["sh", "-c", "yes | head -c 1000000"], ["x"], ignore_errors=True)
+        self.assertNotEqual(status, 0)
+        self.assertIn("exceeding output limit", output)
+        self.assertLess(len(output), 1000000)
+        panic.assert_called_once_with()
+
+    def test_fallback_without_agent(self):
+        agent = piuparts.ChrootAgent(["sh", "-c", "exit 127"])
+        self.assertEqual(agent.run(["echo", "agent"], ["echo", "run"]), (0, "run\n"))
+
+    def test_chroot_run_uses_agent(self):
+        piuparts.settings.chroot_agent = True
+        chroot = piuparts.Chroot()
+        chroot.name = "/nonexistent"
+        chroot.chroot_command = Mock(side_effect=lambda command, interactive=False: command)
+        self.assertEqual(chroot.run(["echo", "one"]), (0, "one\n"))
+        process = chroot.agent.process
+        self.assertEqual(chroot.run(["echo", "two"]), (0, "two\n"))
+        self.assertIs(chroot.agent.process, process)
+        chroot.stop_agent()
+        self.assertIsNone(chroot.agent.process)
+
+
+class RunTests(unittest.TestCase):
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.testobjects = []
+
+    def test_output(self):
+        self.assertEqual(piuparts.run(["printf", "a\r\nb\rc\n"]), (0, "a\nb\nc\n"))
+        self.assertEqual(piuparts.run(["sh", "-c", "printf x; exit 2"], ignore_errors=True), (2, "x"))
+
+    def test_large_output(self):
+        status, output = piuparts.run(["sh", "-c", "yes | head -c 1000000"])
+        self.assertEqual(status, 0)
+        self.assertEqual(output, "y\n" * 500000)
+
+    @patch("piuparts.panic")
+    def test_output_limit_counts_bytes(self, panic):
+        piuparts.settings.max_command_output_size = 100000
+        # 1.5 bytes per character
+        status, output = piuparts.run(["yes", "ä"], ignore_errors=True)
+        self.assertNotEqual(status, 0)
+        self.assertIn("exceeding output limit", output)
+        self.assertLess(len(output), 100000)
+        panic.assert_called_once_with()
+
+    def test_indent_string(self):
+        self.assertEqual(piuparts.indent_string("a\n\nb\n"), "  a\n  \n  b\n  ")
+
+
+class AptArchiveCacheTests(unittest.TestCase):
+
+    testdir = "apt-archive-cache-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.apt_archive_cache = os.path.join(self.testdir, "cache")
+        self.pool = os.path.join(self.testdir, "cache", "archives")
+        os.makedirs(self.pool)
+        self.chroot = piuparts.Chroot()
+        self.chroot.apt_archives_upper = os.path.join(self.testdir, "upper")
+        os.makedirs(os.path.join(self.chroot.apt_archives_upper, "partial"))
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write(self, dirname, name, size, used=None):
+        filename = os.path.join(dirname, name)
+        with open(filename, "wb") as f:
+            f.write(b"x" * size)
+        if used is not None:
+            os.utime(filename, (used, used))
+
+    def test_save_apt_archives(self):
+        self.write(self.chroot.apt_archives_upper, "foo_1.0_amd64.deb", 10)
+        self.write(self.chroot.apt_archives_upper, "lock", 0)
+        self.write(os.path.join(self.chroot.apt_archives_upper, "partial"), "bar_1.0_amd64.deb", 5)
+        self.chroot.save_apt_archives()
+        self.assertEqual(sorted(os.listdir(self.pool)), ["foo_1.0_amd64.deb"])
+        self.assertEqual(os.stat(os.path.join(self.pool, "foo_1.0_amd64.deb")).st_mode & 0o777, 0o644)
+
+    def test_evict_least_recently_used(self):
+        self.write(self.pool, "old_1_all.deb", 400, used=1000)
+        self.write(self.pool, "recent_1_all.deb", 400, used=3000)
+        self.write(self.pool, "older_1_all.deb", 400, used=500)
+        piuparts.evict_apt_archive_cache(self.pool, 1000)
+        self.assertEqual(sorted(os.listdir(self.pool)), ["old_1_all.deb", "recent_1_all.deb"])
+
+    def test_mount_snapshot_of_the_cache(self):
+        piuparts.settings.tmpdir = self.testdir
+        self.write(self.pool, "foo_1_all.deb", 10)
+        self.chroot.mount = Mock()
+        self.chroot.mount_apt_archive_cache()
+        snapshot = self.chroot.apt_archives_snapshot
+        self.assertIn("lowerdir=%s," % snapshot, self.chroot.mount.call_args[1]["opts"])
+        self.assertEqual(os.listdir(snapshot), ["foo_1_all.deb"])
+        # changes of the shared cache don't affect the mounted snapshot
+        piuparts.evict_apt_archive_cache(self.pool, 0)
+        self.write(self.pool, "bar_1_all.deb", 10)
+        self.assertEqual(os.listdir(snapshot), ["foo_1_all.deb"])
+
+
+class AptListsCacheTests(unittest.TestCase):
+
+    testdir = "apt-lists-cache-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.apt_lists_cache = os.path.join(self.testdir, "cache")
+        self.chroot = piuparts.Chroot()
+        self.chroot.name = os.path.join(self.testdir, "chroot")
+        for dirname in ["etc/apt/sources.list.d", "etc/apt/apt.conf.d", "var/lib/apt/lists/partial"]:
+            os.makedirs(self.chroot.relative(dirname))
+        self.write("etc/apt/sources.list", "deb http://deb.debian.org/debian sid main\n")
+        self.write("var/lib/apt/lists/stale_Packages", "stale\n")
+        self.chroot.apt_get_update = Mock(side_effect=self.apt_get_update)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def write(self, filename, content):
+        with open(self.chroot.relative(filename), "w") as f:
+            f.write(content)
+
+    def apt_get_update(self):
+        if os.path.exists(self.chroot.relative("var/lib/apt/lists/stale_Packages")):
+            os.remove(self.chroot.relative("var/lib/apt/lists/stale_Packages"))
+        self.write("var/lib/apt/lists/sid_Packages", "Package: foo\n")
+        self.write("var/lib/apt/lists/lock", "")
+        return 0
+
+    def lists(self):
+        return sorted(os.listdir(self.chroot.relative("var/lib/apt/lists")))
+
+    def test_reuse_lists(self):
+        self.chroot.aptupdate_run()
+        self.assertEqual(self.chroot.apt_get_update.call_count, 1)
+        # a new chroot from the same tarball
+        os.remove(self.chroot.relative("var/lib/apt/lists/sid_Packages"))
+        self.write("var/lib/apt/lists/stale_Packages", "stale\n")
+        self.chroot.aptupdate_run()
+        self.assertEqual(self.chroot.apt_get_update.call_count, 1)
+        self.assertEqual(self.lists(), ["lock", "partial", "sid_Packages"])
+
+    def test_refresh_outdated_lists(self):
+        piuparts.settings.apt_lists_cache_max_age = 0
+        self.chroot.aptupdate_run()
+        self.write("var/lib/apt/lists/stale_Packages", "stale\n")
+        self.chroot.aptupdate_run()
+        self.assertEqual(self.chroot.apt_get_update.call_count, 2)
+
+    def test_key_depends_on_sources(self):
+        key = self.chroot.apt_lists_cache_key()
+        self.write("etc/apt/sources.list", "deb http://deb.debian.org/debian trixie main\n")
+        self.assertNotEqual(self.chroot.apt_lists_cache_key(), key)
+
+    def test_local_repositories_are_not_cached(self):
+        self.write("etc/apt/sources.list.d/local.list", "deb [ trusted=yes ] file:///srv/repo ./\n")
+        self.assertIsNone(self.chroot.apt_lists_cache_key())
+        self.chroot.aptupdate_run()
+        self.chroot.aptupdate_run()
+        self.assertEqual(self.chroot.apt_get_update.call_count, 2)
+
+
+class OverlayChrootTests(unittest.TestCase):
+
+    testdir = "overlay-chroot-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.mkdir(self.testdir)
+        piuparts.settings.tmpdir = os.path.abspath(self.testdir)
+        self.base = piuparts.Chroot()
+        self.base.name = os.path.join(piuparts.settings.tmpdir, "base")
+        os.mkdir(self.base.name)
+        self.base.avail_md5_history = ["0123"]
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_create_overlay_mounts_base_as_lower_layer(self):
+        chroot = piuparts.Chroot()
+        with patch.object(piuparts, "run") as run, \
+                patch.object(chroot, "mount_proc"), patch.object(chroot, "configure_chroot"):
+            chroot.create_overlay(self.base)
+            command = run.call_args_list[0][0][0]
+            self.assertEqual(command[:3], ["mount", "-t", "overlay"])
+            self.assertIn("lowerdir=%s," % self.base.name, command[4])
+            self.assertEqual(command[-1], chroot.name)
+            self.assertEqual(chroot.mounts, [chroot.name])
+            self.assertEqual(chroot.avail_md5_history, ["0123"])
+            self.assertTrue(os.path.isdir(os.path.join(chroot.overlay_layer, "upper")))
+            layer = chroot.overlay_layer
+            chroot.remove()
+            self.assertIn(["rm", "-rf", "--one-file-system", layer],
+                          [c[0][0] for c in run.call_args_list])
+        self.assertIsNone(chroot.overlay_layer)
+
+    def test_freeze_keeps_tmpfs_mounted(self):
+        self.base.mounts = [self.base.name, os.path.join(self.base.name, "proc")]
+        with patch.object(piuparts, "run") as run, \
+                patch.object(self.base, "check_for_no_processes"):
+            self.base.freeze()
+        run.assert_called_once_with(["umount", os.path.join(self.base.name, "proc")], ignore_errors=True)
+        self.assertEqual(self.base.mounts, [self.base.name])
+
+
+class RunJobsTests(unittest.TestCase):
+
+    testdir = "run-jobs-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.jobs = 2
+        os.mkdir(self.testdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def touch(self, name):
+        with open(os.path.join(self.testdir, name), "w"):
+            pass
+
+    def touch_and_panic(self, name):
+        self.touch(name)
+        piuparts.panic()
+
+    def test_run_jobs_counts_failed_jobs(self):
+        jobs = [("a", lambda: self.touch("a")),
+                ("b", lambda: self.touch_and_panic("b")),
+                ("c", lambda: self.touch("c"))]
+        with patch.object(piuparts.logging, "info"), patch.object(piuparts.logging, "error"):
+            self.assertEqual(piuparts.run_jobs(jobs), 1)
+        self.assertEqual(sorted(os.listdir(self.testdir)), ["a", "b", "c"])
+
+    def test_jobs_do_not_run_panic_handlers_of_the_parent(self):
+        cid = piuparts.do_on_panic(lambda: self.touch("parent"))
+        try:
+            with patch.object(piuparts.logging, "info"), patch.object(piuparts.logging, "error"):
+                piuparts.run_jobs([("b", lambda: self.touch_and_panic("b"))])
+        finally:
+            piuparts.dont_do_on_panic(cid)
+        self.assertEqual(os.listdir(self.testdir), ["b"])
+
+    def test_jobs_do_not_save_the_chroot_or_inherit_timings(self):
+        def job():
+            if piuparts.settings.savetgz is None and piuparts.settings.save_end_meta is None \
+                    and not piuparts.phase_timings:
+                self.touch("clean")
+        piuparts.settings.savetgz = os.path.join(self.testdir, "base.tgz")
+        piuparts.settings.save_end_meta = os.path.join(self.testdir, "end-meta")
+        piuparts.phase_timings["install"] = (1, 1.0)
+        try:
+            with patch.object(piuparts.logging, "info"), patch.object(piuparts.logging, "error"):
+                self.assertEqual(piuparts.run_jobs([("a", job)]), 0)
+        finally:
+            piuparts.phase_timings.clear()
+        self.assertEqual(os.listdir(self.testdir), ["clean"])
+
+
+class PhaseTimerTests(unittest.TestCase):
+
+    def setUp(self):
+        piuparts.phase_timings.clear()
+
+    def tearDown(self):
+        piuparts.phase_timings.clear()
+
+    def test_phases_are_logged_and_summed_up(self):
+        with patch.object(piuparts.logging, "info") as info:
+            with piuparts.PhaseTimer("install"):
+                pass
+            with piuparts.PhaseTimer("install"):
+                pass
+            piuparts.log_timing_summary()
+        self.assertRegex(info.call_args_list[0][0][0], r"^PIUPARTS-TIMING phase=install seconds=[0-9.]+$")
+        self.assertEqual(piuparts.phase_timings["install"][0], 2)
+        self.assertIn("install", info.call_args_list[-1][0][0])
+
+    def test_failed_phase_is_not_logged(self):
+        with patch.object(piuparts.logging, "info") as info:
+            with self.assertRaises(SystemExit):
+                with piuparts.PhaseTimer("purge"):
+                    raise SystemExit(1)
+        info.assert_not_called()
+        self.assertEqual(piuparts.phase_timings, {})
+
+    def test_purge_phase_excludes_the_checks(self):
+        clock = [1000.0]
+
+        def check():
+            clock[0] += 100
+
+        piuparts.settings = piuparts.Settings()
+        piuparts.settings.skip_cronfiles_test = True
+        piuparts.settings.skip_logrotatefiles_test = True
+        chroot = piuparts.Chroot()
+        chroot.avail_md5_history = []
+        state = {"avail_md5": [], "selections": {}}
+        with patch.object(piuparts.time, "monotonic", side_effect=lambda: clock[0]), \
+                patch.object(piuparts.logging, "info"), \
+                patch.object(piuparts, "diff_selections", return_value={"foo": ("purge", None)}), \
+                patch.multiple(chroot, list_paths_with_symlinks=DEFAULT, run_scripts=DEFAULT,
+                               remove_packages=DEFAULT, purge_packages=DEFAULT, run=DEFAULT,
+                               check_debsums=check, check_adequate=lambda packages: check()):
+            chroot.restore_selections(state, ["foo"])
+        self.assertEqual(piuparts.phase_timings, {"purge": (2, 0.0)})
+
+    def test_timed_decorator(self):
+        @piuparts.timed("scan")
+        def scan(value):
+            return value
+        with patch.object(piuparts.logging, "info"):
+            self.assertEqual(scan(42), 42)
+        self.assertEqual(piuparts.phase_timings["scan"][0], 1)
+
+
+class ProcessesInDirectoryTests(unittest.TestCase):
+
+    testdir = "processes-in-directory-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.makedirs(os.path.join(self.testdir, "sub"))
+        self.chroot = piuparts.Chroot()
+        self.chroot.name = self.testdir
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def start(self, command):
+        p = subprocess.Popen(command, cwd=os.path.join(self.testdir, "sub"))
+        self.addCleanup(p.wait)
+        self.addCleanup(p.kill)
+        return p
+
+    def test_processes_in_directory(self):
+        p = self.start(["sleep", "60"])
+        processes = piuparts.processes_in_directory(self.testdir)
+        self.assertEqual([pid for (pid, description) in processes], [p.pid])
+        self.assertIn("sleep 60", processes[0][1])
+        self.assertEqual(piuparts.processes_in_directory(self.testdir + "-other"), [])
+
+    def test_terminate_running_processes(self):
+        p = self.start(["sleep", "60"])
+        self.chroot.terminate_running_processes()
+        self.assertEqual(p.wait(), -signal.SIGTERM)
+
+    def test_terminate_escalates_to_sigkill(self):
+        p = self.start(["sh", "-c", "trap '' TERM; sleep 60"])
+        time.sleep(0.2)
+        self.chroot.terminate_running_processes()
+        # either the shell or its sleep got the SIGKILL
+        self.assertIn(p.wait(), (-signal.SIGKILL, 128 + signal.SIGKILL))
+        self.assertEqual(piuparts.processes_in_directory(self.testdir), [])
+
+
+class MetaDataFormatTests(unittest.TestCase):
+
+    testdir = "meta-data-format-testdir"
+
+    def setUp(self):
+        piuparts.settings = piuparts.Settings()
+        os.makedirs(os.path.join(self.testdir, "root/usr/share/doc/foo"))
+        with open(os.path.join(self.testdir, "root/usr/share/doc/foo/copyright"), "w") as f:
+            f.write("copyright\n")
+        os.symlink("foo/copyright", os.path.join(self.testdir, "root/usr/share/doc/bar"))
+        os.symlink("/nonexistent", os.path.join(self.testdir, "root/broken"))
+        self.tree = piuparts.scan_tree_meta_data(os.path.join(self.testdir, "root"),
+                                                 {os.getuid(): "user"}, {os.getgid(): "group"})
+        self.state = {
+            "initial_selections": {"dpkg": ("install", "1.0")},
+            "avail_md5": ["0123", "4567"],
+            "tree": self.tree,
+            "selections": {"dpkg": ("install", "1.1"), "foo": ("deinstall", None)},
+            "diversions": ["diversion of /usr/bin/foo to /usr/bin/foo.real by bar"],
+        }
+        self.filename = os.path.join(self.testdir, "meta")
+
+    def tearDown(self):
+        shutil.rmtree(self.testdir)
+
+    def test_round_trip(self):
+        piuparts.save_meta_data(self.filename, self.state)
+        loaded = piuparts.load_meta_data(self.filename)
+        for key in ["initial_selections", "avail_md5", "selections", "diversions"]:
+            self.assertEqual(loaded[key], self.state[key])
+        self.assertEqual(dict(loaded["tree"]), dict(self.tree))
+        self.assertEqual(sorted(loaded["tree"].symlinks()), ["/broken", "/usr/share/doc/bar"])
+        self.assertEqual(loaded["tree"]["/usr/share/doc/foo/copyright"].user, "user")
+
+    def test_tree_is_loaded_lazily(self):
+        piuparts.save_meta_data(self.filename, self.state)
+        loaded = piuparts.load_meta_data(self.filename)
+        self.assertNotIn("tree", loaded)
+        loaded["tree"]
+        self.assertIn("tree", loaded)
+
+    def test_convert_pickle(self):
+        state = dict(self.state, tree=self.tree.copy())
+        with open(self.filename, "wb") as f:
+            pickle.dump(state, f)
+        loaded = piuparts.load_meta_data(self.filename)
+        self.assertEqual(loaded["selections"], self.state["selections"])
+        with open(self.filename, "rb") as f:
+            self.assertTrue(f.read().startswith(b"PIUPARTS-META 1\n"))
+        self.assertEqual(dict(piuparts.load_meta_data(self.filename)["tree"]), dict(self.tree))
+
+    def test_unsupported_version(self):
+        with open(self.filename, "wb") as f:
+            f.write(b"PIUPARTS-META 999\n")
+        self.assertIsNone(piuparts.load_meta_data(self.filename))